@@ -0,0 +1,7 @@
+# Configuração do gunicorn (carregada de ./gunicorn.conf.py; ver Procfile)
+
+
+def post_worker_init(worker):
+    """Após carregar a aplicação em cada worker, aquece o token do Mainô"""
+    from src.main import iniciar_aquecimento_token
+    iniciar_aquecimento_token()
@@ -0,0 +1,35 @@
+import os
+
+from flask import request
+from flask_caching import Cache
+
+cache = Cache()
+
+# Dados compartilhados entre workers (token do Mainô, locks) em um prefixo
+# próprio, para não serem descartados pelo cache.clear() das respostas
+cache_compartilhado = Cache()
+
+# Sem REDIS_URL o cache é a memória de cada processo: cache.clear() só limpa o
+# worker que gravou a nota, e os demais servem a resposta antiga até ela expirar.
+# Nesse caso as respostas ficam em cache por no máximo TTL_MAXIMO_LOCAL segundos.
+CACHE_LOCAL = not os.getenv('REDIS_URL')
+TTL_MAXIMO_LOCAL = 5
+
+
+def ttl(segundos: int) -> int:
+    """Tempo de cache de uma resposta, limitado a TTL_MAXIMO_LOCAL sem Redis"""
+    return min(segundos, TTL_MAXIMO_LOCAL) if CACHE_LOCAL else segundos
+
+
+def apenas_sucesso(response) -> bool:
+    """Só armazena em cache respostas 200 (erros não devem ser reaproveitados)"""
+    if isinstance(response, tuple):
+        return len(response) < 2 or response[1] == 200
+    return getattr(response, 'status_code', 200) == 200
+
+
+def chave_autocomplete(*args, **kwargs) -> str:
+    """Chave das buscas de autocomplete: rota + modo + termo normalizado (sem caixa)"""
+    termo = request.args.get('q', '').strip().lower()
+    prefixo = request.args.get('prefix', 'false').lower() == 'true'
+    return f"autocomplete:{request.path}:{int(prefixo)}:{termo}"
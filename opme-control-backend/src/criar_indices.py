@@ -0,0 +1,99 @@
+"""
+Cria em um banco já existente os índices declarados nos modelos e remove
+os que saíram deles
+
+db.create_all() (executado na inicialização da aplicação) só cria índices
+junto com tabelas novas. Este script é executado uma vez após o deploy de
+uma versão com índices novos:
+
+    cd opme-control-backend
+    python -m src.criar_indices
+
+No PostgreSQL os índices são criados com CREATE INDEX CONCURRENTLY, sem
+bloquear a gravação de notas durante a construção. Se uma construção for
+interrompida, o índice fica marcado como INVALID: remova-o com DROP INDEX e
+execute o script novamente.
+
+No PostgreSQL, também recria ck_saldo_cliente_cnpj_digitos nas tabelas que
+têm a versão antiga da constraint, que recusava CNPJ vazio.
+"""
+import logging
+
+from sqlalchemy import text
+
+from src.main import app
+from src.models.user import db
+
+logger = logging.getLogger(__name__)
+
+# Índices que deixaram de ser declarados nos modelos (cobertos por outros)
+INDICES_REMOVIDOS = (
+    'ix_saldo_cliente_produto',  # prefixo de _cliente_produto_lote_nf_uc
+    'ix_saldo_lookup',           # coberto pela constraint única e por ix_saldo_lookup_disp
+)
+
+# Definição atual da constraint de CNPJ (ver SaldoMaterial.__table_args__)
+CK_CNPJ_DIGITOS = "cliente_cnpj ~ '^[0-9]*$'"
+
+
+def _indices_existentes(conn):
+    """Nomes dos índices do SQLite (a reflexão não enxerga índices de expressão)"""
+    return {
+        nome for (nome,) in conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index'")
+        )
+    }
+
+
+def _atualizar_ck_cnpj(conn):
+    """Recria a constraint de CNPJ com a definição atual (somente PostgreSQL)"""
+    # Só existe em tabelas criadas depois da constraint; nas demais nada é feito
+    existe = conn.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'ck_saldo_cliente_cnpj_digitos'"
+    )).first()
+    if existe is None:
+        return
+    # NOT VALID + VALIDATE evita bloquear gravações enquanto as linhas são verificadas
+    conn.execute(text(
+        'ALTER TABLE saldos_materiais DROP CONSTRAINT IF EXISTS ck_saldo_cliente_cnpj_digitos'
+    ))
+    conn.execute(text(
+        'ALTER TABLE saldos_materiais ADD CONSTRAINT ck_saldo_cliente_cnpj_digitos '
+        f'CHECK ({CK_CNPJ_DIGITOS}) NOT VALID'
+    ))
+    conn.execute(text(
+        'ALTER TABLE saldos_materiais VALIDATE CONSTRAINT ck_saldo_cliente_cnpj_digitos'
+    ))
+    logger.info("Constraint atualizada: ck_saldo_cliente_cnpj_digitos")
+
+
+def criar_indices():
+    """Cria os índices dos modelos que ainda não existem no banco"""
+    # CONCURRENTLY não pode rodar dentro de uma transação
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        sqlite = conn.dialect.name == 'sqlite'
+        concorrente = ' CONCURRENTLY' if conn.dialect.name == 'postgresql' else ''
+
+        for nome in INDICES_REMOVIDOS:
+            conn.execute(text(f'DROP INDEX{concorrente} IF EXISTS {nome}'))
+            logger.info(f"Índice removido (se existia): {nome}")
+
+        if conn.dialect.name == 'postgresql':
+            _atualizar_ck_cnpj(conn)
+
+        existentes = _indices_existentes(conn) if sqlite else None
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if sqlite and index.name in existentes:
+                    continue
+                index.dialect_options['postgresql']['concurrently'] = True
+                # Índices restritos a um dialeto (Index.ddl_if) são respeitados por create()
+                index.create(bind=conn, checkfirst=not sqlite)
+                logger.info(f"Índice verificado: {index.name}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        criar_indices()
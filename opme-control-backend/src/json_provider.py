@@ -0,0 +1,46 @@
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Provider JSON do Flask baseado em orjson (serialização em C)
+    
+    Mantém a ordenação de chaves do provider padrão, e datas, Decimal e
+    demais tipos não nativos continuam passando pelo `default` do Flask.
+    A saída não é idêntica byte a byte à do provider padrão:
+
+    - texto não ASCII sai em UTF-8 ("ç") e não como escape ("\\u00e7");
+    - NaN e Infinity viram null, e alguns floats mudam de grafia (1e16 em
+      vez de 1e+16);
+    - chaves não string são convertidas pelo orjson: datas em ISO 8601
+      (o provider padrão recusa essas chaves).
+
+    Os valores decodificados são os mesmos nos demais casos.
+    """
+    
+    def _options(self, kwargs) -> int:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return option
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(
+            obj, default=kwargs.get('default', self.default), option=self._options(kwargs)
+        ).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        """Como o provider padrão, mas grava os bytes do orjson sem recodificar"""
+        obj = self._prepare_response_obj(args, kwargs)
+        dump_args = {}
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            dump_args['indent'] = 2
+        
+        body = orjson.dumps(obj, default=self.default, option=self._options(dump_args))
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
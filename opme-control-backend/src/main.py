@@ -1,31 +1,106 @@
+import logging
 import os
 import sys
+import threading
 
 from flask import Flask, send_from_directory
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
 
 # Adicionar o diretório raiz ao path para imports relativos
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 # Imports dos módulos da aplicação
+from src.cache import CACHE_LOCAL, TTL_MAXIMO_LOCAL, cache, cache_compartilhado
+from src.json_provider import OrjsonProvider
 from src.models.user import db
 from src.routes.user import user_bp
 from src.routes.notas_fiscais import notas_fiscais_bp
+from src.routes.export import export_bp
+from src.routes.saldos import saldos_bp
+from src.services.maino_api import MainoAPIService
 
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 
 app.register_blueprint(user_bp, url_prefix='/api')
 app.register_blueprint(notas_fiscais_bp, url_prefix='/api')
+app.register_blueprint(saldos_bp, url_prefix='/api/saldos')
+app.register_blueprint(export_bp, url_prefix='/api/export')
 
 
 # Configuração do banco de dados
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
+database_url = os.getenv(
+    'DATABASE_URL',
+    f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
+)
+# SQLAlchemy não aceita mais o esquema legado postgres://
+if database_url.startswith('postgres://'):
+    database_url = database_url.replace('postgres://', 'postgresql://', 1)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool de conexões reaproveitado entre requisições (em produção, DATABASE_URL
+# pode apontar para um PgBouncer em modo transaction)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800
+}
+if make_url(database_url).get_driver_name() == 'psycopg2':
+    # INSERTs em lote saem como um único INSERT ... VALUES (...), (...) por
+    # página e UPDATEs em lote usam execute_batch, em vez de um comando por linha
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update({
+        'executemany_mode': 'values_plus_batch',
+        'insertmanyvalues_page_size': 1000,
+        'executemany_batch_page_size': 500
+    })
 db.init_app(app)
+
+# Cache de respostas: Redis em produção (REDIS_URL), memória local caso contrário
+redis_url = os.getenv('REDIS_URL')
+app.config['CACHE_TYPE'] = 'RedisCache' if redis_url else 'SimpleCache'
+app.config['CACHE_REDIS_URL'] = redis_url
+app.config['CACHE_KEY_PREFIX'] = 'opme:'
+app.config['CACHE_DEFAULT_TIMEOUT'] = 60
+cache.init_app(app)
+cache_compartilhado.init_app(app, config={
+    'CACHE_TYPE': app.config['CACHE_TYPE'],
+    'CACHE_REDIS_URL': redis_url,
+    'CACHE_KEY_PREFIX': 'opme-shared:'
+})
+if CACHE_LOCAL and 'gunicorn' in os.getenv('SERVER_SOFTWARE', ''):
+    # Cada worker do gunicorn tem o próprio cache e só o que gravou é invalidado
+    logging.getLogger(__name__).warning(
+        "REDIS_URL não configurada: cache local por worker, respostas podem ficar "
+        f"até {TTL_MAXIMO_LOCAL}s desatualizadas nos demais workers"
+    )
+
 with app.app_context():
+    if db.engine.dialect.name == 'postgresql':
+        # Índices trigram da busca de clientes/produtos dependem da extensão pg_trgm
+        with db.engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    # create_all não adiciona índices novos a tabelas já existentes; nesse
+    # caso, execute uma vez `python -m src.criar_indices` após o deploy
     db.create_all()
 
+# Obtém o token OAuth2 do Mainô em segundo plano, para que a primeira requisição
+# de cada worker não precise autenticar (com API Key não há token). Chamado pelo
+# servidor ao iniciar cada worker (post_worker_init em gunicorn.conf.py), e não na
+# importação do módulo, para que scripts como src.criar_indices não chamem a API
+def _aquecer_token_maino():
+    with app.app_context():
+        MainoAPIService()._ensure_authenticated()
+
+def iniciar_aquecimento_token():
+    """Inicia o aquecimento do token do Mainô, se houver credenciais OAuth2"""
+    if (os.getenv('MAINO_APPLICATION_UID') and os.getenv('MAINO_EMAIL')
+            and os.getenv('MAINO_PASSWORD') and not os.getenv('MAINO_API_KEY')):
+        threading.Thread(target=_aquecer_token_maino, daemon=True).start()
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
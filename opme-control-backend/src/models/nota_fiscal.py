@@ -1,7 +1,23 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import gzip
+import re
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import validates
 from src.models.user import db
 
+_NAO_DIGITOS = re.compile(r'\D')
+# Tabela para str.translate que remove todo caractere ASCII que não é dígito
+_NAO_DIGITOS_ASCII = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+def normalizar_cnpj(cnpj: str) -> str:
+    """Mantém apenas os dígitos de um CNPJ/CPF (formato gravado no banco)"""
+    if not cnpj:
+        return cnpj
+    cnpj = cnpj.translate(_NAO_DIGITOS_ASCII)
+    # Sobrou caractere fora do ASCII (raro): a regex remove o que não for dígito
+    return cnpj if cnpj.isascii() else _NAO_DIGITOS.sub('', cnpj)
+
 class NotaFiscal(db.Model):
     __tablename__ = 'notas_fiscais'
     
@@ -17,17 +33,36 @@ class NotaFiscal(db.Model):
     destinatario_cnpj = db.Column(db.String(14), nullable=False)
     destinatario_nome = db.Column(db.String(255), nullable=False)
     
-    # Metadados
-    xml_content = db.Column(db.Text)
+    # Metadados; o XML original fica comprimido em notas_fiscais_xml (a coluna
+    # xml_content só é lida para notas gravadas antes dessa tabela)
+    xml_content = db.deferred(db.Column(db.Text))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relacionamento com itens
-    itens = db.relationship('ItemNotaFiscal', backref='nota_fiscal', lazy=True, cascade='all, delete-orphan')
+    itens = db.relationship('ItemNotaFiscal', back_populates='nota_fiscal', lazy='selectin', cascade='all, delete-orphan')
+    
+    # XML original, carregado apenas quando acessado
+    xml = db.relationship('NotaFiscalXML', uselist=False, lazy='select', cascade='all, delete-orphan')
+    
+    # Índices para os filtros e a ordenação da listagem e das estatísticas
+    __table_args__ = (
+        db.Index('ix_nf_tipo_data', 'tipo_operacao', 'data_emissao'),
+        db.Index('ix_nf_dest_cnpj_data', 'destinatario_cnpj', 'data_emissao'),
+        db.Index('ix_nf_data_id', 'data_emissao', 'id'),
+        # Agrupamento mensal das estatísticas (somente PostgreSQL)
+        db.Index('ix_nf_month', db.func.date_trunc('month', data_emissao)).ddl_if(dialect='postgresql'),
+    )
     
     def __repr__(self):
         return f'<NotaFiscal {self.numero}/{self.serie}>'
     
+    def obter_xml(self):
+        """XML original da nota (tabela comprimida ou coluna legada)"""
+        if self.xml is not None:
+            return self.xml.xml_content
+        return self.xml_content
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -44,6 +79,26 @@ class NotaFiscal(db.Model):
             'itens': [item.to_dict() for item in self.itens]
         }
 
+class NotaFiscalXML(db.Model):
+    """XML original de uma nota fiscal, gravado comprimido (gzip) fora da tabela principal"""
+    __tablename__ = 'notas_fiscais_xml'
+    
+    chave_acesso = db.Column(db.String(44), db.ForeignKey('notas_fiscais.chave_acesso'), primary_key=True)
+    xml_gzip = db.Column(db.LargeBinary, nullable=False)
+    
+    def __init__(self, chave_acesso: str, xml_content: str = None, xml_gzip: bytes = None):
+        """Recebe o XML como texto ou já comprimido (xml_gzip, ex.: direto do upload)"""
+        if xml_gzip is None:
+            xml_gzip = gzip.compress(xml_content.encode('utf-8'), compresslevel=6)
+        super().__init__(chave_acesso=chave_acesso, xml_gzip=xml_gzip)
+    
+    @property
+    def xml_content(self) -> str:
+        return gzip.decompress(self.xml_gzip).decode('utf-8')
+    
+    def __repr__(self):
+        return f'<NotaFiscalXML {self.chave_acesso}>'
+
 class ItemNotaFiscal(db.Model):
     __tablename__ = 'itens_nota_fiscal'
     
@@ -53,9 +108,9 @@ class ItemNotaFiscal(db.Model):
     # Dados do produto
     codigo_produto = db.Column(db.String(50), nullable=False)
     descricao_produto = db.Column(db.String(500), nullable=False)
-    quantidade = db.Column(db.Numeric(15, 4), nullable=False)
-    valor_unitario = db.Column(db.Numeric(15, 4))
-    valor_total = db.Column(db.Numeric(15, 2))
+    quantidade = db.Column(db.Numeric(15, 4, asdecimal=False), nullable=False)
+    valor_unitario = db.Column(db.Numeric(15, 4, asdecimal=False))
+    valor_total = db.Column(db.Numeric(15, 2, asdecimal=False))
     
     # Dados do lote
     numero_lote = db.Column(db.String(50))
@@ -65,6 +120,9 @@ class ItemNotaFiscal(db.Model):
     # Metadados
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Relacionamento com a nota fiscal
+    nota_fiscal = db.relationship('NotaFiscal', back_populates='itens')
+    
     def __repr__(self):
         return f'<ItemNotaFiscal {self.codigo_produto} - Lote: {self.numero_lote}>'
     
@@ -74,9 +132,9 @@ class ItemNotaFiscal(db.Model):
             'nota_fiscal_id': self.nota_fiscal_id,
             'codigo_produto': self.codigo_produto,
             'descricao_produto': self.descricao_produto,
-            'quantidade': float(self.quantidade) if self.quantidade else 0,
-            'valor_unitario': float(self.valor_unitario) if self.valor_unitario else 0,
-            'valor_total': float(self.valor_total) if self.valor_total else 0,
+            'quantidade': self.quantidade or 0,
+            'valor_unitario': self.valor_unitario or 0,
+            'valor_total': self.valor_total or 0,
             'numero_lote': self.numero_lote,
             'data_fabricacao': self.data_fabricacao.isoformat() if self.data_fabricacao else None,
             'data_validade': self.data_validade.isoformat() if self.data_validade else None,
@@ -100,26 +158,70 @@ class SaldoMaterial(db.Model):
     nf_saida_serie = db.Column(db.String(10), nullable=False)
     nf_saida_chave = db.Column(db.String(44), nullable=False)
     
-    # Quantidades
-    quantidade_enviada = db.Column(db.Numeric(15, 4), nullable=False, default=0)
-    quantidade_retornada = db.Column(db.Numeric(15, 4), nullable=False, default=0)
-    quantidade_utilizada = db.Column(db.Numeric(15, 4), nullable=False, default=0)
-    quantidade_faturada = db.Column(db.Numeric(15, 4), nullable=False, default=0)
+    # Quantidades (retornadas como float pelo driver, sem conversão de Decimal)
+    quantidade_enviada = db.Column(db.Numeric(15, 4, asdecimal=False), nullable=False, default=0)
+    quantidade_retornada = db.Column(db.Numeric(15, 4, asdecimal=False), nullable=False, default=0)
+    quantidade_utilizada = db.Column(db.Numeric(15, 4, asdecimal=False), nullable=False, default=0)
+    quantidade_faturada = db.Column(db.Numeric(15, 4, asdecimal=False), nullable=False, default=0)
     
     # Metadados
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Índices únicos para evitar duplicatas
+    # Índices únicos para evitar duplicatas; o índice da constraint também
+    # atende os filtros por cliente, cliente/produto e cliente/produto/lote
     __table_args__ = (
         db.UniqueConstraint('cliente_cnpj', 'codigo_produto', 'numero_lote', 'nf_saida_chave', 
                           name='_cliente_produto_lote_nf_uc'),
+        # CNPJ/CPF gravado somente com dígitos (somente PostgreSQL, em tabelas novas);
+        # vazio é aceito para destinatários sem CNPJ/CPF (estrangeiros, com idEstrangeiro)
+        db.CheckConstraint("cliente_cnpj ~ '^[0-9]*$'",
+                           name='ck_saldo_cliente_cnpj_digitos').ddl_if(dialect='postgresql'),
+        # Filtro por produto na consulta e exportação de saldos
+        db.Index('ix_saldo_codigo', 'codigo_produto'),
+        # Ordenação (e cursor) da consulta de saldos
+        db.Index('ix_saldo_sort', cliente_nome, codigo_produto, created_at.desc(), id.desc()),
+        # Busca do saldo a baixar em retornos/simbólicos/faturamentos (mais antigo primeiro);
+        # o índice parcial cobre só as linhas com saldo disponível, mesma condição da consulta
+        db.Index('ix_saldo_lookup_disp', cliente_cnpj, codigo_produto, numero_lote, created_at,
+                 postgresql_where=quantidade_enviada - quantidade_retornada - quantidade_utilizada > 0,
+                 sqlite_where=quantidade_enviada - quantidade_retornada - quantidade_utilizada > 0),
+        # Índice de expressão para filtros sobre o saldo disponível
+        db.Index('ix_saldos_saldo_disp',
+                 quantidade_enviada - quantidade_retornada - quantidade_utilizada),
+        # Autocomplete por prefixo: lower(coluna) LIKE 'termo%' (somente PostgreSQL)
+        db.Index('ix_saldo_cliente_nome_lower', db.func.lower(cliente_nome).label('cliente_nome_lower'),
+                 postgresql_ops={'cliente_nome_lower': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_saldo_codigo_lower', db.func.lower(codigo_produto).label('codigo_produto_lower'),
+                 postgresql_ops={'codigo_produto_lower': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_saldo_descricao_lower', db.func.lower(descricao_produto).label('descricao_produto_lower'),
+                 postgresql_ops={'descricao_produto_lower': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+        # Busca por substring (ILIKE '%termo%') via trigramas (somente PostgreSQL, requer pg_trgm)
+        db.Index('ix_saldo_cliente_nome_trgm', 'cliente_nome', postgresql_using='gin',
+                 postgresql_ops={'cliente_nome': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_saldo_codigo_trgm', 'codigo_produto', postgresql_using='gin',
+                 postgresql_ops={'codigo_produto': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_saldo_descricao_trgm', 'descricao_produto', postgresql_using='gin',
+                 postgresql_ops={'descricao_produto': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        # Autocomplete de clientes por trecho do CNPJ/CPF (termo só com dígitos)
+        db.Index('ix_saldo_cliente_cnpj_trgm', 'cliente_cnpj', postgresql_using='gin',
+                 postgresql_ops={'cliente_cnpj': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
     )
     
-    @property
+    @hybrid_property
     def saldo_disponivel(self):
         """Calcula o saldo disponível (enviado - retornado - utilizado)"""
-        return float(self.quantidade_enviada) - float(self.quantidade_retornada) - float(self.quantidade_utilizada)
+        return self.quantidade_enviada - self.quantidade_retornada - self.quantidade_utilizada
+    
+    @saldo_disponivel.expression
+    def saldo_disponivel(cls):
+        """Mesma expressão calculada no banco, para uso em filtros e agregações"""
+        return cls.quantidade_enviada - cls.quantidade_retornada - cls.quantidade_utilizada
+    
+    @validates('cliente_cnpj')
+    def _validar_cliente_cnpj(self, key, cnpj):
+        """Normaliza o CNPJ/CPF na gravação, para que os filtros usem igualdade simples"""
+        return normalizar_cnpj(cnpj)
     
     def __repr__(self):
         return f'<SaldoMaterial {self.cliente_cnpj} - {self.codigo_produto} - Lote: {self.numero_lote}>'
@@ -135,10 +237,10 @@ class SaldoMaterial(db.Model):
             'nf_saida_numero': self.nf_saida_numero,
             'nf_saida_serie': self.nf_saida_serie,
             'nf_saida_chave': self.nf_saida_chave,
-            'quantidade_enviada': float(self.quantidade_enviada),
-            'quantidade_retornada': float(self.quantidade_retornada),
-            'quantidade_utilizada': float(self.quantidade_utilizada),
-            'quantidade_faturada': float(self.quantidade_faturada),
+            'quantidade_enviada': self.quantidade_enviada,
+            'quantidade_retornada': self.quantidade_retornada,
+            'quantidade_utilizada': self.quantidade_utilizada,
+            'quantidade_faturada': self.quantidade_faturada,
             'saldo_disponivel': self.saldo_disponivel,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
@@ -1,17 +1,42 @@
 from flask import Blueprint, request, jsonify, send_file
 from datetime import datetime
-import pandas as pd
+from functools import lru_cache
 import io
+import itertools
 import os
+import tempfile
+import xlsxwriter
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, LongTable, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from src.services.saldo_service import SaldoService
 
 export_bp = Blueprint('export', __name__)
 
+# Rótulos dos filtros exibidos no PDF (o período é tratado à parte)
+_FILTER_LABELS = (
+    ('cliente_nome', 'Cliente'),
+    ('cliente_cnpj', 'CNPJ'),
+    ('codigo_produto', 'Produto'),
+    ('cfop', 'CFOP'),
+)
+
+# Pontuação removida antes de formatar CNPJ/CPF
+_CNPJ_PUNCTUATION = str.maketrans('', '', '.-/ ')
+
+EXCEL_HEADERS = [
+    'Cliente', 'CNPJ/CPF', 'Código Produto', 'Descrição Produto', 'Número Lote',
+    'Quantidade Enviada', 'Quantidade Retornada', 'Quantidade Utilizada',
+    'Saldo Disponível', 'Status'
+]
+
+PDF_HEADERS = ['Cliente', 'CNPJ/CPF', 'Produto', 'Lote', 'Enviado', 'Retornado', 'Utilizado', 'Saldo']
+
+# Limite de linhas da tabela do PDF
+PDF_MAX_ROWS = 10000
+
 @export_bp.route('/saldos/excel', methods=['GET'])
 def export_saldos_excel():
     """Exporta saldos para Excel"""
@@ -29,51 +54,50 @@ def export_saldos_excel():
         # Remove filtros vazios
         filtros = {k: v for k, v in filtros.items() if v}
         
-        # Busca todos os saldos (sem paginação para export)
-        saldos = SaldoService.consultar_saldos(filtros, page=1, per_page=10000)
+        # Percorre os saldos em lotes (sem paginação nem lista intermediária)
+        saldos = SaldoService.iterar_saldos(filtros)
+        primeiro = next(saldos, None)
         
-        if not saldos['data']:
+        if primeiro is None:
             return jsonify({'error': 'Nenhum saldo encontrado para exportar'}), 404
         
-        # Converte para DataFrame
-        df_data = []
-        for saldo in saldos['data']:
-            df_data.append({
-                'Cliente': saldo['cliente_nome'],
-                'CNPJ/CPF': _format_cnpj(saldo['cliente_cnpj']),
-                'Código Produto': saldo['codigo_produto'],
-                'Descrição Produto': saldo['descricao_produto'],
-                'Número Lote': saldo['numero_lote'],
-                'Quantidade Enviada': saldo['quantidade_enviada'],
-                'Quantidade Retornada': saldo['quantidade_retornada'],
-                'Quantidade Utilizada': saldo['quantidade_utilizada'],
-                'Saldo Disponível': saldo['saldo_disponivel'],
-                'Status': _get_status_label(saldo['saldo_disponivel'])
-            })
-        
-        df = pd.DataFrame(df_data)
-        
-        # Cria arquivo Excel em memória
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Saldos OPME', index=False)
-            
-            # Formata a planilha
-            worksheet = writer.sheets['Saldos OPME']
+        # Grava o Excel linha a linha em arquivo temporário: com constant_memory
+        # cada linha vai para disco assim que escrita (in_memory desativaria isso)
+        output = tempfile.TemporaryFile()
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Saldos OPME')
+        header_format = workbook.add_format({'bold': True})
+        
+        worksheet.write_row(0, 0, EXCEL_HEADERS, header_format)
+        
+        # Largura das colunas calculada durante a escrita das linhas
+        col_widths = [len(h) for h in EXCEL_HEADERS]
+        
+        for row_num, saldo in enumerate(itertools.chain([primeiro], saldos), start=1):
+            row = [
+                saldo['cliente_nome'],
+                _format_cnpj(saldo['cliente_cnpj']),
+                saldo['codigo_produto'],
+                saldo['descricao_produto'],
+                saldo['numero_lote'],
+                saldo['quantidade_enviada'],
+                saldo['quantidade_retornada'],
+                saldo['quantidade_utilizada'],
+                saldo['saldo_disponivel'],
+                _get_status_label(saldo['saldo_disponivel'])
+            ]
+            worksheet.write_row(row_num, 0, row)
             
-            # Ajusta largura das colunas
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+            for i, value in enumerate(row):
+                length = len(str(value))
+                if length > col_widths[i]:
+                    col_widths[i] = length
+        
+        # Ajusta largura das colunas
+        for i, width in enumerate(col_widths):
+            worksheet.set_column(i, i, min(width + 2, 50))
         
+        workbook.close()
         output.seek(0)
         
         # Nome do arquivo com timestamp
@@ -107,10 +131,11 @@ def export_saldos_pdf():
         # Remove filtros vazios
         filtros = {k: v for k, v in filtros.items() if v}
         
-        # Busca todos os saldos (sem paginação para export)
-        saldos = SaldoService.consultar_saldos(filtros, page=1, per_page=10000)
+        # Percorre os saldos em lotes, limitado a PDF_MAX_ROWS linhas
+        saldos = itertools.islice(SaldoService.iterar_saldos(filtros), PDF_MAX_ROWS)
+        primeiro = next(saldos, None)
         
-        if not saldos['data']:
+        if primeiro is None:
             return jsonify({'error': 'Nenhum saldo encontrado para exportar'}), 404
         
         # Cria PDF em memória
@@ -142,33 +167,22 @@ def export_saldos_pdf():
         elements.append(data_geracao)
         elements.append(Spacer(1, 20))
         
-        # Filtros aplicados
-        if any(filtros.values()):
-            filtros_text = "Filtros aplicados: "
-            filtros_list = []
-            if filtros.get('cliente_nome'):
-                filtros_list.append(f"Cliente: {filtros['cliente_nome']}")
-            if filtros.get('cliente_cnpj'):
-                filtros_list.append(f"CNPJ: {filtros['cliente_cnpj']}")
-            if filtros.get('codigo_produto'):
-                filtros_list.append(f"Produto: {filtros['codigo_produto']}")
-            if filtros.get('data_inicio') and filtros.get('data_fim'):
-                filtros_list.append(f"Período: {filtros['data_inicio']} a {filtros['data_fim']}")
-            if filtros.get('cfop'):
-                filtros_list.append(f"CFOP: {filtros['cfop']}")
-            
-            filtros_text += "; ".join(filtros_list)
-            filtros_para = Paragraph(filtros_text, styles['Normal'])
+        # Filtros aplicados (filtros já vem sem valores vazios)
+        filtros_list = [
+            f"{label}: {filtros[key]}" for key, label in _FILTER_LABELS if key in filtros
+        ]
+        if 'data_inicio' in filtros and 'data_fim' in filtros:
+            filtros_list.append(f"Período: {filtros['data_inicio']} a {filtros['data_fim']}")
+        
+        if filtros_list:
+            filtros_para = Paragraph("Filtros aplicados: " + "; ".join(filtros_list), styles['Normal'])
             elements.append(filtros_para)
             elements.append(Spacer(1, 20))
         
-        # Tabela de dados
-        table_data = [
-            ['Cliente', 'CNPJ/CPF', 'Produto', 'Lote', 'Enviado', 'Retornado', 'Utilizado', 'Saldo']
-        ]
-        
-        for saldo in saldos['data']:
-            table_data.append([
+        # Tabela de dados: as linhas são formatadas conforme os saldos são lidos,
+        # sem manter a lista de dicts em memória
+        rows = (
+            [
                 _truncate_text(saldo['cliente_nome'], 25),
                 _format_cnpj(saldo['cliente_cnpj']),
                 _truncate_text(saldo['codigo_produto'], 15),
@@ -177,10 +191,19 @@ def export_saldos_pdf():
                 str(saldo['quantidade_retornada']),
                 str(saldo['quantidade_utilizada']),
                 str(saldo['saldo_disponivel'])
-            ])
+            ]
+            for saldo in itertools.chain([primeiro], saldos)
+        )
         
-        # Cria tabela
-        table = Table(table_data)
+        # Cria tabela (LongTable quebra por página e repete o cabeçalho; as células
+        # já são strings, então o reportlab não precisa normalizar uma cópia)
+        dados = list(itertools.chain([PDF_HEADERS], rows))
+        linhas_exibidas = len(dados) - 1
+        table = LongTable(
+            dados,
+            repeatRows=1,
+            normalizedData=1
+        )
         table.setStyle(TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
@@ -198,17 +221,21 @@ def export_saldos_pdf():
         
         # Resumo
         elements.append(Spacer(1, 30))
-        total_registros = len(saldos['data'])
-        saldos_positivos = len([s for s in saldos['data'] if s['saldo_disponivel'] > 0])
-        saldos_zerados = len([s for s in saldos['data'] if s['saldo_disponivel'] == 0])
-        saldos_negativos = len([s for s in saldos['data'] if s['saldo_disponivel'] < 0])
+        # O resumo conta todos os saldos do filtro; se a tabela foi cortada em
+        # PDF_MAX_ROWS, o relatório informa quantas linhas foram exibidas
+        contagem = SaldoService.contar_por_status(filtros)
+        aviso_limite = (
+            f"Mostrando {linhas_exibidas} de {contagem['total']} registros "
+            f"(limite de {PDF_MAX_ROWS} linhas por relatório)<br/>"
+            if linhas_exibidas < contagem['total'] else ''
+        )
         
         resumo_text = f"""
         <b>Resumo:</b><br/>
-        Total de registros: {total_registros}<br/>
-        Saldos positivos: {saldos_positivos}<br/>
-        Saldos zerados: {saldos_zerados}<br/>
-        Saldos negativos: {saldos_negativos}
+        {aviso_limite}Total de registros: {contagem['total']}<br/>
+        Saldos positivos: {contagem['positivos']}<br/>
+        Saldos zerados: {contagem['zerados']}<br/>
+        Saldos negativos: {contagem['negativos']}
         """
         
         resumo = Paragraph(resumo_text, styles['Normal'])
@@ -232,12 +259,14 @@ def export_saldos_pdf():
     except Exception as e:
         return jsonify({'error': f'Erro ao exportar PDF: {str(e)}'}), 500
 
+@lru_cache(maxsize=4096)
 def _format_cnpj(cnpj):
-    """Formata CNPJ/CPF"""
+    """Formata CNPJ/CPF (memoizado: exportações repetem o mesmo cliente em vários lotes)"""
     if not cnpj:
         return ''
     
-    cnpj = str(cnpj).zfill(14) if len(str(cnpj)) > 11 else str(cnpj).zfill(11)
+    cnpj = str(cnpj).translate(_CNPJ_PUNCTUATION)
+    cnpj = cnpj.zfill(14) if len(cnpj) > 11 else cnpj.zfill(11)
     
     if len(cnpj) == 14:
         return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
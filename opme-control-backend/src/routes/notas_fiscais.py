@@ -1,7 +1,14 @@
 from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
+import base64
 import os
+import re
 import tempfile
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, lazyload, raiseload, selectinload
+from src.cache import cache, apenas_sucesso, ttl
 from src.services.saldo_service import SaldoService
 from src.services.maino_api import MainoAPIService
 from src.models.nota_fiscal import NotaFiscal, db
@@ -11,6 +18,11 @@ logger = logging.getLogger(__name__)
 
 notas_fiscais_bp = Blueprint('notas_fiscais', __name__)
 
+_DATA_RE = re.compile(r'^\d{2}/\d{2}/\d{4}$')
+
+# Pontuação removida do filtro de CNPJ/CPF
+_CNPJ_PUNCTUATION = str.maketrans('', '', './-() ')
+
 @notas_fiscais_bp.route('/upload-xml', methods=['POST'])
 def upload_xml():
     """Upload manual de XML de nota fiscal"""
@@ -25,11 +37,8 @@ def upload_xml():
         if not file.filename.lower().endswith('.xml'):
             return jsonify({'error': 'Apenas arquivos XML são aceitos'}), 400
         
-        # Lê o conteúdo do arquivo
-        xml_content = file.read().decode('utf-8')
-        
-        # Processa a nota fiscal
-        resultado = SaldoService.processar_nota_fiscal(xml_content)
+        # Processa a nota fiscal direto do stream do upload
+        resultado = SaldoService.processar_nota_fiscal_stream(file.stream)
         
         if resultado['success']:
             return jsonify({
@@ -73,18 +82,22 @@ def sync_maino():
         if not maino_service.test_connection():
             return jsonify({'error': 'Falha na conexão com a API do Mainô'}), 500
         
-        # Sincroniza notas fiscais
-        notas = maino_service.sync_notas_fiscais(data_inicio, data_fim)
-        
-        # Processa cada nota fiscal
         resultados = []
+        total_notas = 0
         sucessos = 0
         erros = 0
         
-        for nota in notas:
-            xml_content = nota.get('xml_content')
-            if xml_content:
-                resultado = SaldoService.processar_nota_fiscal(xml_content)
+        # Sincroniza página a página: cada página é gravada em lote, com um
+        # único commit, antes de buscar a próxima
+        for notas in maino_service.sync_notas_fiscais(data_inicio, data_fim):
+            total_notas += len(notas)
+            
+            notas_com_xml = [nota for nota in notas if nota.get('xml_content')]
+            resultados_lote = SaldoService.processar_notas_fiscais_bulk(
+                [nota['xml_content'] for nota in notas_com_xml]
+            )
+            
+            for nota, resultado in zip(notas_com_xml, resultados_lote):
                 if resultado['success']:
                     sucessos += 1
                 else:
@@ -99,7 +112,7 @@ def sync_maino():
             'success': True,
             'message': f'Sincronização concluída: {sucessos} sucessos, {erros} erros',
             'resumo': {
-                'total_notas': len(notas),
+                'total_notas': total_notas,
                 'sucessos': sucessos,
                 'erros': erros
             },
@@ -111,26 +124,65 @@ def sync_maino():
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
 @notas_fiscais_bp.route('/listar', methods=['GET'])
+@cache.cached(timeout=ttl(30), query_string=True, response_filter=apenas_sucesso)
 def listar_notas_fiscais():
-    """Lista notas fiscais processadas"""
+    """
+    Lista notas fiscais processadas
+    
+    Com o parâmetro `cursor` usa paginação por keyset em (data_emissao, id):
+    envie `cursor=` vazio para a primeira página e depois o `next_cursor`
+    retornado. Sem ele, mantém a paginação por `page` (OFFSET).
+    """
     try:
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 20, type=int), 100)
         tipo_operacao = request.args.get('tipo_operacao')
         cliente_cnpj = request.args.get('cliente_cnpj')
+        cursor = request.args.get('cursor')
         
-        query = NotaFiscal.query
+        # Carrega os itens em uma única consulta IN e bloqueia lazy loads acidentais
+        query = NotaFiscal.query.options(
+            selectinload(NotaFiscal.itens),
+            raiseload('*')
+        )
         
         # Filtros
         if tipo_operacao:
             query = query.filter(NotaFiscal.tipo_operacao == tipo_operacao)
         
         if cliente_cnpj:
-            cliente_cnpj = ''.join(filter(str.isdigit, cliente_cnpj))
+            cliente_cnpj = cliente_cnpj.translate(_CNPJ_PUNCTUATION)
             query = query.filter(NotaFiscal.destinatario_cnpj == cliente_cnpj)
         
+        query = query.order_by(NotaFiscal.data_emissao.desc(), NotaFiscal.id.desc())
+        
+        if cursor is not None:
+            # Paginação por keyset: busca a partir da última nota vista, sem OFFSET
+            if cursor:
+                posicao = _decode_cursor(cursor)
+                if posicao is None:
+                    return jsonify({'error': 'Cursor inválido'}), 400
+                query = query.filter(
+                    tuple_(NotaFiscal.data_emissao, NotaFiscal.id) < posicao
+                )
+            
+            # Uma linha a mais indica se existe próxima página
+            notas = query.limit(per_page + 1).all()
+            has_next = len(notas) > per_page
+            notas = notas[:per_page]
+            
+            return jsonify({
+                'success': True,
+                'data': [nota.to_dict() for nota in notas],
+                'pagination': {
+                    'per_page': per_page,
+                    'has_next': has_next,
+                    'next_cursor': _encode_cursor(notas[-1]) if has_next else None
+                }
+            }), 200
+        
         # Paginação
-        notas = query.order_by(NotaFiscal.data_emissao.desc()).paginate(
+        notas = query.paginate(
             page=page, per_page=per_page, error_out=False
         )
         
@@ -155,7 +207,9 @@ def listar_notas_fiscais():
 def obter_nota_fiscal(nota_id):
     """Obtém detalhes de uma nota fiscal específica"""
     try:
-        nota = NotaFiscal.query.get_or_404(nota_id)
+        nota = NotaFiscal.query.options(
+            selectinload(NotaFiscal.itens)
+        ).filter_by(id=nota_id).first_or_404()
         return jsonify({
             'success': True,
             'data': nota.to_dict()
@@ -169,9 +223,13 @@ def obter_nota_fiscal(nota_id):
 def obter_xml_nota_fiscal(nota_id):
     """Obtém o XML original de uma nota fiscal"""
     try:
-        nota = NotaFiscal.query.get_or_404(nota_id)
+        nota = NotaFiscal.query.options(
+            joinedload(NotaFiscal.xml),
+            lazyload(NotaFiscal.itens)
+        ).filter_by(id=nota_id).first_or_404()
         
-        if not nota.xml_content:
+        xml_content = nota.obter_xml()
+        if not xml_content:
             return jsonify({'error': 'XML não disponível para esta nota fiscal'}), 404
         
         return jsonify({
@@ -180,7 +238,7 @@ def obter_xml_nota_fiscal(nota_id):
                 'chave_acesso': nota.chave_acesso,
                 'numero': nota.numero,
                 'serie': nota.serie,
-                'xml_content': nota.xml_content
+                'xml_content': xml_content
             }
         }), 200
         
@@ -210,6 +268,7 @@ def test_maino_connection():
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
 @notas_fiscais_bp.route('/estatisticas', methods=['GET'])
+@cache.cached(timeout=ttl(60), response_filter=apenas_sucesso)
 def obter_estatisticas():
     """Obtém estatísticas das notas fiscais processadas"""
     try:
@@ -220,11 +279,20 @@ def obter_estatisticas():
         ).group_by(NotaFiscal.tipo_operacao).all()
         
         # Total de notas por mês (últimos 12 meses)
+        if db.engine.dialect.name == 'postgresql':
+            # 'month' como literal para coincidir com o índice ix_nf_month
+            mes_expr = db.func.date_trunc(db.literal_column("'month'"), NotaFiscal.data_emissao)
+        else:
+            mes_expr = db.func.strftime('%Y-%m', NotaFiscal.data_emissao)
+        
+        # Limite calculado na aplicação para manter o filtro indexável
+        limite_mensal = datetime.now() - relativedelta(months=12)
+        
         stats_mensal = db.session.query(
-            db.func.strftime('%Y-%m', NotaFiscal.data_emissao).label('mes'),
+            mes_expr.label('mes'),
             db.func.count(NotaFiscal.id).label('total')
         ).filter(
-            NotaFiscal.data_emissao >= db.func.date('now', '-12 months')
+            NotaFiscal.data_emissao >= limite_mensal
         ).group_by('mes').order_by('mes').all()
         
         # Clientes com mais movimentação
@@ -245,7 +313,10 @@ def obter_estatisticas():
                     for op, total in stats_operacao
                 ],
                 'por_mes': [
-                    {'mes': mes, 'total': total} 
+                    {
+                        'mes': mes.strftime('%Y-%m') if isinstance(mes, datetime) else mes,
+                        'total': total
+                    }
                     for mes, total in stats_mensal
                 ],
                 'top_clientes': [
@@ -265,10 +336,24 @@ def obter_estatisticas():
 
 def _validar_formato_data(data_str: str) -> bool:
     """Valida se a data está no formato DD/MM/YYYY"""
+    # Rejeita formatos inválidos antes de pagar o custo do strptime
+    if not _DATA_RE.match(data_str):
+        return False
     try:
-        from datetime import datetime
         datetime.strptime(data_str, '%d/%m/%Y')
         return True
     except ValueError:
         return False
 
+def _encode_cursor(nota: NotaFiscal) -> str:
+    """Gera o cursor opaco (base64 de `data_emissao|id`) da última nota da página"""
+    valor = f"{nota.data_emissao.isoformat()}|{nota.id}"
+    return base64.urlsafe_b64encode(valor.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    """Decodifica o cursor em (data_emissao, id), ou None se for inválido"""
+    try:
+        data_str, nota_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(data_str), int(nota_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
@@ -1,6 +1,9 @@
-from flask import Blueprint, request, jsonify
+from collections import defaultdict
+from itertools import chain
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from src.cache import cache, apenas_sucesso, chave_autocomplete, ttl
 from src.services.saldo_service import SaldoService
-from src.models.nota_fiscal import SaldoMaterial, db
+from src.models.nota_fiscal import SaldoMaterial, db, normalizar_cnpj
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,56 +20,32 @@ def consultar_saldos():
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 20, type=int), 100)
         
-        # Monta a query base
-        query = SaldoMaterial.query
-        
-        # Aplica filtros
-        if cliente_cnpj:
-            cliente_cnpj = ''.join(filter(str.isdigit, cliente_cnpj))
-            query = query.filter(SaldoMaterial.cliente_cnpj == cliente_cnpj)
-        
-        if cliente_nome:
-            query = query.filter(
-                SaldoMaterial.cliente_nome.ilike(f'%{cliente_nome}%')
-            )
-        
-        if codigo_produto:
-            query = query.filter(
-                db.or_(
-                    SaldoMaterial.codigo_produto.ilike(f'%{codigo_produto}%'),
-                    SaldoMaterial.descricao_produto.ilike(f'%{codigo_produto}%')
+        filtros = {
+            'cliente_cnpj': cliente_cnpj,
+            'cliente_nome': cliente_nome,
+            'codigo_produto': codigo_produto
+        }
+        
+        if 'cursor' in request.args:
+            # Paginação por keyset: `cursor=` vazio para a primeira página, depois
+            # o `next_cursor` retornado; o total só é contado com ?include_total=1
+            try:
+                saldos = SaldoService.consultar_saldos_cursor(
+                    filtros,
+                    cursor=request.args.get('cursor'),
+                    per_page=per_page,
+                    incluir_total=request.args.get('include_total') == '1'
                 )
-            )
-        
-        # Ordena por cliente, produto e data
-        query = query.order_by(
-            SaldoMaterial.cliente_nome,
-            SaldoMaterial.codigo_produto,
-            SaldoMaterial.created_at.desc()
-        )
-        
-        # Paginação
-        saldos = query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        # Calcula totais
-        saldos_data = []
-        for saldo in saldos.items:
-            saldo_dict = saldo.to_dict()
-            saldos_data.append(saldo_dict)
+            except ValueError:
+                return jsonify({'error': 'Cursor inválido'}), 400
+        else:
+            # Consulta por colunas, sem hidratar objetos do ORM
+            saldos = SaldoService.consultar_saldos(filtros, page=page, per_page=per_page)
         
         return jsonify({
             'success': True,
-            'data': saldos_data,
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': saldos.total,
-                'pages': saldos.pages,
-                'has_next': saldos.has_next,
-                'has_prev': saldos.has_prev
-            }
+            'data': saldos['data'],
+            'pagination': saldos['pagination']
         }), 200
         
     except Exception as e:
@@ -78,67 +57,56 @@ def consultar_saldos_cliente(cliente_cnpj):
     """Consulta saldos de um cliente específico"""
     try:
         # Remove caracteres especiais do CNPJ
-        cliente_cnpj = ''.join(filter(str.isdigit, cliente_cnpj))
+        cliente_cnpj = normalizar_cnpj(cliente_cnpj)
         
         if len(cliente_cnpj) not in [11, 14]:  # CPF ou CNPJ
             return jsonify({'error': 'CNPJ/CPF inválido'}), 400
         
-        saldos = SaldoService.consultar_saldos_cliente(cliente_cnpj=cliente_cnpj)
+        # Detalhe por NF de saída pode ser omitido com ?incluir_nfs=false
+        incluir_nfs = request.args.get('incluir_nfs', 'true').lower() != 'false'
         
-        # Agrupa por produto para facilitar visualização
-        produtos = {}
-        for saldo in saldos:
-            key = f"{saldo['codigo_produto']}_{saldo['numero_lote']}"
-            if key not in produtos:
-                produtos[key] = {
-                    'codigo_produto': saldo['codigo_produto'],
-                    'descricao_produto': saldo['descricao_produto'],
-                    'numero_lote': saldo['numero_lote'],
-                    'nfs_saida': [],
-                    'total_enviado': 0,
-                    'total_retornado': 0,
-                    'total_utilizado': 0,
-                    'total_faturado': 0,
-                    'saldo_total': 0
-                }
-            
-            produtos[key]['nfs_saida'].append({
-                'nf_numero': saldo['nf_saida_numero'],
-                'nf_serie': saldo['nf_saida_serie'],
-                'nf_chave': saldo['nf_saida_chave'],
-                'quantidade_enviada': saldo['quantidade_enviada'],
-                'quantidade_retornada': saldo['quantidade_retornada'],
-                'quantidade_utilizada': saldo['quantidade_utilizada'],
-                'quantidade_faturada': saldo['quantidade_faturada'],
-                'saldo_disponivel': saldo['saldo_disponivel']
-            })
-            
-            produtos[key]['total_enviado'] += saldo['quantidade_enviada']
-            produtos[key]['total_retornado'] += saldo['quantidade_retornada']
-            produtos[key]['total_utilizado'] += saldo['quantidade_utilizada']
-            produtos[key]['total_faturado'] += saldo['quantidade_faturada']
-            produtos[key]['saldo_total'] += saldo['saldo_disponivel']
-        
-        # Informações do cliente
-        cliente_info = None
-        if saldos:
-            cliente_info = {
-                'cnpj': saldos[0]['cliente_cnpj'],
-                'nome': saldos[0]['cliente_nome']
-            }
+        # Produtos/lotes chegam um a um do banco; a primeira linha é buscada
+        # antes de abrir a resposta para que erros de consulta ainda virem 500
+        grupos = SaldoService.iterar_saldos_cliente_agrupado(cliente_cnpj, incluir_nfs)
+        primeiro = next(grupos, None)
         
-        return jsonify({
-            'success': True,
-            'data': {
-                'cliente': cliente_info,
-                'produtos': list(produtos.values()),
-                'resumo': {
-                    'total_produtos': len(produtos),
-                    'total_nfs': len(saldos),
-                    'produtos_com_saldo': len([p for p in produtos.values() if p['saldo_total'] > 0])
+        if primeiro is None:
+            return jsonify({
+                'success': True,
+                'data': {
+                    'cliente': None,
+                    'produtos': [],
+                    'resumo': {
+                        'total_produtos': 0,
+                        'total_nfs': 0,
+                        'produtos_com_saldo': 0
+                    }
                 }
-            }
-        }), 200
+            }), 200
+        
+        dumps = current_app.json.dumps
+        
+        def gerar():
+            # Mesmo documento do jsonify (chaves em ordem alfabética), emitido
+            # por produto; o resumo é acumulado durante a passada e vai ao final
+            resumo = {'total_produtos': 0, 'total_nfs': 0, 'produtos_com_saldo': 0}
+            yield '{"data":{"cliente":' + dumps({'cnpj': cliente_cnpj, 'nome': primeiro[0]})
+            yield ',"produtos":['
+            try:
+                for _, nfs_grupo, produto in chain([primeiro], grupos):
+                    separador = ',' if resumo['total_produtos'] else ''
+                    resumo['total_produtos'] += 1
+                    resumo['total_nfs'] += nfs_grupo
+                    if produto['saldo_total'] > 0:
+                        resumo['produtos_com_saldo'] += 1
+                    yield separador + dumps(produto)
+            except Exception as e:
+                # O status já foi enviado; interrompe a resposta incompleta
+                logger.error(f"Erro ao transmitir saldos do cliente: {str(e)}")
+                raise
+            yield '],"resumo":' + dumps(resumo) + '},"success":true}\n'
+        
+        return Response(stream_with_context(gerar()), mimetype='application/json'), 200
         
     except Exception as e:
         logger.error(f"Erro ao consultar saldos do cliente: {str(e)}")
@@ -148,24 +116,37 @@ def consultar_saldos_cliente(cliente_cnpj):
 def consultar_saldos_produto(codigo_produto):
     """Consulta saldos de um produto específico"""
     try:
-        saldos = SaldoService.consultar_saldos_produto(codigo_produto)
+        # Por padrão o código é buscado por substring; ?exato=1 busca o código exato
+        exato = request.args.get('exato', 'false').lower() in ('1', 'true')
+        
+        # Paginação opcional por ?limit=&offset= (sem limit, retorna todos os lotes)
+        limit = request.args.get('limit', type=int)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        if limit is not None:
+            limit = min(max(limit, 1), 1000)
+            # Uma linha a mais indica se existe próxima página
+            saldos = SaldoService.consultar_saldos_produto(codigo_produto, limit=limit + 1,
+                                                           offset=offset, exato=exato)
+            has_next = len(saldos) > limit
+            saldos = saldos[:limit]
+        else:
+            saldos = SaldoService.consultar_saldos_produto(codigo_produto, exato=exato)
         
         # Agrupa por cliente
-        clientes = {}
+        clientes = defaultdict(lambda: {
+            'lotes': [],
+            'total_enviado': 0,
+            'total_retornado': 0,
+            'total_utilizado': 0,
+            'saldo_total': 0
+        })
         for saldo in saldos:
-            cnpj = saldo['cliente_cnpj']
-            if cnpj not in clientes:
-                clientes[cnpj] = {
-                    'cliente_cnpj': cnpj,
-                    'cliente_nome': saldo['cliente_nome'],
-                    'lotes': [],
-                    'total_enviado': 0,
-                    'total_retornado': 0,
-                    'total_utilizado': 0,
-                    'saldo_total': 0
-                }
+            cliente = clientes[saldo['cliente_cnpj']]
+            if 'cliente_cnpj' not in cliente:
+                cliente['cliente_cnpj'] = saldo['cliente_cnpj']
+                cliente['cliente_nome'] = saldo['cliente_nome']
             
-            clientes[cnpj]['lotes'].append({
+            cliente['lotes'].append({
                 'numero_lote': saldo['numero_lote'],
                 'nf_saida_numero': saldo['nf_saida_numero'],
                 'nf_saida_serie': saldo['nf_saida_serie'],
@@ -175,10 +156,14 @@ def consultar_saldos_produto(codigo_produto):
                 'saldo_disponivel': saldo['saldo_disponivel']
             })
             
-            clientes[cnpj]['total_enviado'] += saldo['quantidade_enviada']
-            clientes[cnpj]['total_retornado'] += saldo['quantidade_retornada']
-            clientes[cnpj]['total_utilizado'] += saldo['quantidade_utilizada']
-            clientes[cnpj]['saldo_total'] += saldo['saldo_disponivel']
+            cliente['total_enviado'] += saldo['quantidade_enviada']
+            cliente['total_retornado'] += saldo['quantidade_retornada']
+            cliente['total_utilizado'] += saldo['quantidade_utilizada']
+            cliente['saldo_total'] += saldo['saldo_disponivel']
+        
+        # Uma única passada sobre os grupos para a lista e a contagem com saldo
+        lista_clientes = list(clientes.values())
+        clientes_com_saldo = sum(1 for c in lista_clientes if c['saldo_total'] > 0)
         
         # Informações do produto
         produto_info = None
@@ -188,50 +173,41 @@ def consultar_saldos_produto(codigo_produto):
                 'descricao': saldos[0]['descricao_produto']
             }
         
-        return jsonify({
+        resposta = {
             'success': True,
             'data': {
                 'produto': produto_info,
-                'clientes': list(clientes.values()),
+                'clientes': lista_clientes,
                 'resumo': {
                     'total_clientes': len(clientes),
                     'total_lotes': len(saldos),
-                    'clientes_com_saldo': len([c for c in clientes.values() if c['saldo_total'] > 0])
+                    'clientes_com_saldo': clientes_com_saldo
                 }
             }
-        }), 200
+        }
+        if limit is not None:
+            # Na página, clientes e resumo cobrem apenas os lotes retornados
+            resposta['pagination'] = {
+                'limit': limit,
+                'offset': offset,
+                'has_next': has_next
+            }
+        
+        return jsonify(resposta), 200
         
     except Exception as e:
         logger.error(f"Erro ao consultar saldos do produto: {str(e)}")
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
 @saldos_bp.route('/resumo', methods=['GET'])
+@cache.cached(timeout=ttl(300), response_filter=apenas_sucesso)
 def obter_resumo_saldos():
     """Obtém resumo geral dos saldos"""
     try:
         resumo = SaldoService.obter_resumo_saldos()
         
         # Saldos críticos (produtos com pouco estoque)
-        saldos_criticos = SaldoMaterial.query.filter(
-            db.and_(
-                SaldoMaterial.quantidade_enviada > 
-                (SaldoMaterial.quantidade_retornada + SaldoMaterial.quantidade_utilizada),
-                (SaldoMaterial.quantidade_enviada - 
-                 SaldoMaterial.quantidade_retornada - 
-                 SaldoMaterial.quantidade_utilizada) <= 5  # Menos de 5 unidades
-            )
-        ).limit(10).all()
-        
-        resumo['saldos_criticos'] = [
-            {
-                'cliente_nome': saldo.cliente_nome,
-                'codigo_produto': saldo.codigo_produto,
-                'descricao_produto': saldo.descricao_produto,
-                'numero_lote': saldo.numero_lote,
-                'saldo_disponivel': saldo.saldo_disponivel
-            }
-            for saldo in saldos_criticos
-        ]
+        resumo['saldos_criticos'] = SaldoService.listar_saldos_criticos()
         
         return jsonify({
             'success': True,
@@ -243,6 +219,7 @@ def obter_resumo_saldos():
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
 @saldos_bp.route('/buscar-clientes', methods=['GET'])
+@cache.cached(timeout=ttl(60), make_cache_key=chave_autocomplete, response_filter=apenas_sucesso)
 def buscar_clientes():
     """Busca clientes para autocomplete"""
     try:
@@ -254,23 +231,27 @@ def buscar_clientes():
                 'data': []
             }), 200
         
+        # Com ?prefix=true a busca é ancorada no início ('termo%'), o que
+        # permite usar índices btree; caso contrário busca por substring
+        prefix = request.args.get('prefix', 'false').lower() == 'true'
+        padrao = 'prefixo' if prefix else 'contem'
+        
         # Busca por nome ou CNPJ
         if termo.isdigit():
             # Busca por CNPJ
-            clientes = db.session.query(
-                SaldoMaterial.cliente_cnpj,
-                SaldoMaterial.cliente_nome
-            ).filter(
-                SaldoMaterial.cliente_cnpj.like(f'%{termo}%')
-            ).distinct().limit(10).all()
+            filtro = SaldoService.filtro_texto(SaldoMaterial.cliente_cnpj, termo, padrao)
         else:
             # Busca por nome
-            clientes = db.session.query(
-                SaldoMaterial.cliente_cnpj,
-                SaldoMaterial.cliente_nome
-            ).filter(
-                SaldoMaterial.cliente_nome.ilike(f'%{termo}%')
-            ).distinct().limit(10).all()
+            filtro = SaldoService.filtro_texto(SaldoMaterial.cliente_nome, termo, padrao)
+        
+        # Um registro por CNPJ: o GROUP BY percorre o índice da constraint única
+        # na ordem do CNPJ e para após 10 grupos, sem DISTINCT sobre a linha inteira
+        clientes = db.session.query(
+            SaldoMaterial.cliente_cnpj,
+            db.func.min(SaldoMaterial.cliente_nome)
+        ).filter(filtro).group_by(
+            SaldoMaterial.cliente_cnpj
+        ).order_by(SaldoMaterial.cliente_cnpj).limit(10).all()
         
         resultado = [
             {
@@ -291,6 +272,7 @@ def buscar_clientes():
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
 @saldos_bp.route('/buscar-produtos', methods=['GET'])
+@cache.cached(timeout=ttl(60), make_cache_key=chave_autocomplete, response_filter=apenas_sucesso)
 def buscar_produtos():
     """Busca produtos para autocomplete"""
     try:
@@ -302,16 +284,20 @@ def buscar_produtos():
                 'data': []
             }), 200
         
+        # Com ?prefix=true a busca é ancorada no início ('termo%')
+        prefix = request.args.get('prefix', 'false').lower() == 'true'
+        padrao = 'prefixo' if prefix else 'contem'
+        
         # Busca por código ou descrição
+        filtro = db.or_(
+            SaldoService.filtro_texto(SaldoMaterial.codigo_produto, termo, padrao),
+            SaldoService.filtro_texto(SaldoMaterial.descricao_produto, termo, padrao)
+        )
+        
         produtos = db.session.query(
             SaldoMaterial.codigo_produto,
             SaldoMaterial.descricao_produto
-        ).filter(
-            db.or_(
-                SaldoMaterial.codigo_produto.ilike(f'%{termo}%'),
-                SaldoMaterial.descricao_produto.ilike(f'%{termo}%')
-            )
-        ).distinct().limit(10).all()
+        ).filter(filtro).distinct().limit(10).all()
         
         resultado = [
             {
@@ -1,14 +1,61 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-from typing import Dict, List, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 import logging
+from src.cache import cache_compartilhado
 
 logger = logging.getLogger(__name__)
 
+# Sessão HTTP compartilhada: mantém conexões keep-alive com a API do Mainô
+# e evita um novo handshake TCP/TLS a cada chamada. Falhas transitórias do
+# gateway (502/503/504) em requisições idempotentes são repetidas com backoff.
+http_session = requests.Session()
+http_session.headers.update({'Content-Type': 'application/json'})
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+http_session.mount('https://', _adapter)
+http_session.mount('http://', _adapter)
+
 class MainoAPIService:
     """Serviço para integração com a API do Mainô"""
     
+    # Tempo (segundos) em que um teste de conexão bem-sucedido é reaproveitado
+    PROBE_CACHE_TTL = 30
+    
+    # Último teste de conexão bem-sucedido por base URL (time.monotonic())
+    _probe_cache: Dict[str, float] = {}
+    
+    # Token OAuth2 compartilhado entre instâncias: (base_url, email) -> (token, expiração)
+    _token_cache: Dict[Tuple[str, str], Tuple[str, datetime]] = {}
+    _token_lock = threading.Lock()
+    
+    # Entre workers, o token é publicado no cache compartilhado (Redis em produção)
+    # e só o worker que obtém o lock AUTH_LOCK_KEY faz o POST de autenticação
+    AUTH_LOCK_KEY = 'maino:auth:lock'
+    AUTH_LOCK_TIMEOUT = 30
+    AUTH_WAIT_TIMEOUT = 10
+    
+    # Downloads de XML simultâneos durante a sincronização (<= pool_maxsize da sessão)
+    SYNC_WORKERS = 16
+    
+    # Notas por página pedidas à API durante a sincronização
+    SYNC_PAGE_SIZE = 500
+    
+    # XMLs já baixados por chave de acesso (um XML emitido não muda)
+    XML_CACHE_SIZE = 1024
+    _xml_cache: 'OrderedDict[str, str]' = OrderedDict()
+    _xml_lock = threading.Lock()
+    
     def __init__(self):
         self.base_url = os.getenv('MAINO_API_BASE_URL', 'https://api.maino.com.br')
         self.application_uid = os.getenv('MAINO_APPLICATION_UID')
@@ -17,6 +64,13 @@ class MainoAPIService:
         self.api_key = os.getenv('MAINO_API_KEY')
         self.access_token = None
         self.token_expires_at = None
+        self.session = http_session
+        
+        # Reaproveita o token obtido por outra instância, se ainda válido
+        cached = MainoAPIService._token_cache.get((self.base_url, self.email))
+        if cached:
+            self.access_token, self.token_expires_at = cached
+        self._atualizar_headers()
     
     def authenticate(self) -> bool:
         """
@@ -37,7 +91,7 @@ class MainoAPIService:
                 "password": self.password
             }
             
-            response = requests.post(url, json=payload, timeout=30)
+            response = self.session.post(url, json=payload, timeout=30)
             response.raise_for_status()
             
             data = response.json()
@@ -48,6 +102,11 @@ class MainoAPIService:
                     self.access_token = user_data['access_token']
                     # Define expiração do token para 1 hora (padrão)
                     self.token_expires_at = datetime.now() + timedelta(hours=1)
+                    MainoAPIService._token_cache[(self.base_url, self.email)] = (
+                        self.access_token, self.token_expires_at
+                    )
+                    self._atualizar_headers()
+                    self._publicar_token()
                     logger.info("Autenticação no Mainô realizada com sucesso")
                     return True
             
@@ -62,30 +121,110 @@ class MainoAPIService:
             return False
     
     def _get_headers(self) -> Dict[str, str]:
-        """Retorna headers para requisições autenticadas"""
+        """Retorna headers de autenticação (Content-Type já é padrão da sessão)"""
+        return self._headers
+    
+    def _atualizar_headers(self):
+        """Remonta os headers de autenticação; chamado só quando a credencial muda"""
         if self.api_key:
-            return {
-                'X-Api-Key': self.api_key,
-                'Content-Type': 'application/json'
-            }
+            self._headers = {'X-Api-Key': self.api_key}
         elif self.access_token:
-            return {
-                'Authorization': f'Bearer {self.access_token}',
-                'Content-Type': 'application/json'
-            }
+            self._headers = {'Authorization': f'Bearer {self.access_token}'}
         else:
-            return {'Content-Type': 'application/json'}
+            self._headers = {}
     
     def _ensure_authenticated(self) -> bool:
         """Garante que há um token válido"""
         if self.api_key:
             return True
         
-        if (self.access_token and self.token_expires_at and 
-            datetime.now() < self.token_expires_at):
+        if self._token_valido():
             return True
         
-        return self.authenticate()
+        # Só uma thread renova o token; as demais reaproveitam o resultado
+        with MainoAPIService._token_lock:
+            if self._carregar_token(MainoAPIService._token_cache.get((self.base_url, self.email))):
+                return True
+            if self._adotar_token_publicado():
+                return True
+            try:
+                obteve_lock = cache_compartilhado.add(self.AUTH_LOCK_KEY, 1, timeout=self.AUTH_LOCK_TIMEOUT)
+            except Exception:
+                # Sem cache compartilhado: cada worker autentica por conta própria
+                return self.authenticate()
+            if obteve_lock:
+                try:
+                    return self.authenticate()
+                finally:
+                    try:
+                        cache_compartilhado.delete(self.AUTH_LOCK_KEY)
+                    except Exception:
+                        pass
+        
+        # Outro worker está autenticando: aguarda fora do lock local, para não
+        # bloquear as demais threads deste worker que precisam do token
+        return self._aguardar_token_publicado()
+    
+    def _carregar_token(self, cached: Optional[Tuple[str, datetime]]) -> bool:
+        """Adota um token (token, expiração) obtido em outro lugar; True se ainda válido"""
+        if not cached:
+            return False
+        self.access_token, self.token_expires_at = cached
+        self._atualizar_headers()
+        return self._token_valido()
+    
+    def _chave_token(self) -> str:
+        return f"maino:token:{self.base_url}:{self.email}"
+    
+    def _token_publicado(self) -> Optional[Tuple[str, datetime]]:
+        """Token publicado por outro worker no cache compartilhado, se houver"""
+        try:
+            return cache_compartilhado.get(self._chave_token())
+        except Exception:
+            # Fora do contexto da aplicação ou cache indisponível
+            return None
+    
+    def _adotar_token_publicado(self) -> bool:
+        """Adota o token publicado por outro worker, guardando-o no cache do processo"""
+        if not self._carregar_token(self._token_publicado()):
+            return False
+        MainoAPIService._token_cache[(self.base_url, self.email)] = (
+            self.access_token, self.token_expires_at
+        )
+        return True
+    
+    def _publicar_token(self):
+        """Publica o token obtido para os demais workers"""
+        try:
+            timeout = int((self.token_expires_at - datetime.now()).total_seconds())
+            cache_compartilhado.set(
+                self._chave_token(), (self.access_token, self.token_expires_at), timeout=timeout
+            )
+        except Exception as e:
+            logger.warning(f"Não foi possível publicar o token do Mainô: {str(e)}")
+    
+    def _aguardar_token_publicado(self) -> bool:
+        """
+        Aguarda (até AUTH_WAIT_TIMEOUT) o token do worker que obteve o lock
+        AUTH_LOCK_KEY; se não vier a tempo, autentica diretamente
+        """
+        prazo = time.monotonic() + self.AUTH_WAIT_TIMEOUT
+        while time.monotonic() < prazo:
+            time.sleep(0.5)
+            if self._adotar_token_publicado():
+                return True
+        
+        logger.warning("Token do Mainô não publicado a tempo; autenticando diretamente")
+        with MainoAPIService._token_lock:
+            # Outra thread deste worker pode ter autenticado enquanto esta aguardava
+            if self._carregar_token(MainoAPIService._token_cache.get((self.base_url, self.email))):
+                return True
+            return self.authenticate()
+    
+    def _token_valido(self) -> bool:
+        """Indica se há um token de acesso ainda não expirado"""
+        return bool(self.access_token and self.token_expires_at and
+                    datetime.now() < self.token_expires_at)
     
     def get_notas_fiscais_emitidas(self, data_inicio: str = None, data_fim: str = None, 
                                  page: int = 1, per_page: int = 100) -> Optional[Dict]:
@@ -119,8 +258,8 @@ class MainoAPIService:
             if data_fim:
                 params['data_fim'] = data_fim
             
-            response = requests.get(url, headers=self._get_headers(), 
-                                  params=params, timeout=30)
+            response = self.session.get(url, headers=self._get_headers(), 
+                                        params=params, timeout=30)
             response.raise_for_status()
             
             return response.json()
@@ -142,6 +281,25 @@ class MainoAPIService:
         Returns:
             String com o conteúdo XML ou None em caso de erro
         """
+        with MainoAPIService._xml_lock:
+            xml_content = MainoAPIService._xml_cache.get(chave_acesso)
+            if xml_content is not None:
+                MainoAPIService._xml_cache.move_to_end(chave_acesso)
+                return xml_content
+        
+        xml_content = self._buscar_xml_nfe(chave_acesso)
+        
+        # Erros não são armazenados, para que a próxima chamada tente de novo
+        if xml_content is not None:
+            with MainoAPIService._xml_lock:
+                MainoAPIService._xml_cache[chave_acesso] = xml_content
+                if len(MainoAPIService._xml_cache) > self.XML_CACHE_SIZE:
+                    MainoAPIService._xml_cache.popitem(last=False)
+        
+        return xml_content
+    
+    def _buscar_xml_nfe(self, chave_acesso: str) -> Optional[str]:
+        """Baixa o XML de uma NFe na API do Mainô (sem cache)"""
         if not self._ensure_authenticated():
             logger.error("Falha na autenticação")
             return None
@@ -154,8 +312,8 @@ class MainoAPIService:
                 'chave_acesso': chave_acesso
             }
             
-            response = requests.get(url, headers=self._get_headers(), 
-                                  params=params, timeout=30)
+            response = self.session.get(url, headers=self._get_headers(), 
+                                        params=params, timeout=30)
             response.raise_for_status()
             
             # Assume que a resposta contém o XML diretamente ou em um campo específico
@@ -177,74 +335,108 @@ class MainoAPIService:
             logger.error(f"Erro inesperado: {str(e)}")
             return None
     
-    def sync_notas_fiscais(self, data_inicio: str = None, data_fim: str = None) -> List[Dict]:
+    def sync_notas_fiscais(self, data_inicio: str = None, data_fim: str = None) -> Iterator[List[Dict]]:
         """
-        Sincroniza notas fiscais do Mainô
+        Sincroniza notas fiscais do Mainô, página a página
+        
+        Gerador: cada página (até SYNC_PAGE_SIZE notas, já com xml_content) é
+        entregue assim que seus XMLs são baixados, para que o chamador grave e
+        libere a página antes de buscar a próxima. Os XMLs de cada página são
+        baixados em paralelo (SYNC_WORKERS threads), reaproveitando as conexões
+        da sessão HTTP compartilhada.
         
         Args:
             data_inicio: Data início no formato DD/MM/YYYY
             data_fim: Data fim no formato DD/MM/YYYY
             
-        Returns:
-            Lista de notas fiscais processadas
+        Yields:
+            Lista de notas fiscais de cada página
         """
-        notas_processadas = []
+        total_notas = 0
         page = 1
         
-        while True:
-            logger.info(f"Buscando página {page} de notas fiscais")
-            
-            data = self.get_notas_fiscais_emitidas(
-                data_inicio=data_inicio,
-                data_fim=data_fim,
-                page=page
-            )
-            
-            if not data or not data.get('data'):
-                break
-            
-            notas = data.get('data', [])
-            if not notas:
-                break
-            
-            for nota in notas:
-                # Processa cada nota fiscal
-                chave_acesso = nota.get('chave_acesso')
-                if chave_acesso:
-                    xml_content = self.get_xml_nfe(chave_acesso)
+        # Autentica antes de abrir as threads, para que não disputem o token
+        if not self._ensure_authenticated():
+            logger.error("Falha na autenticação")
+            return
+        
+        with ThreadPoolExecutor(max_workers=self.SYNC_WORKERS) as executor:
+            while True:
+                logger.info(f"Buscando página {page} de notas fiscais")
+                
+                data = self.get_notas_fiscais_emitidas(
+                    data_inicio=data_inicio,
+                    data_fim=data_fim,
+                    page=page,
+                    per_page=self.SYNC_PAGE_SIZE
+                )
+                
+                if not data or not data.get('data'):
+                    break
+                
+                notas = data.get('data', [])
+                if not notas:
+                    break
+                
+                # Baixa os XMLs da página em paralelo (map preserva a ordem das notas)
+                notas_com_chave = [nota for nota in notas if nota.get('chave_acesso')]
+                xmls = executor.map(
+                    self.get_xml_nfe,
+                    [nota['chave_acesso'] for nota in notas_com_chave]
+                )
+                for nota, xml_content in zip(notas_com_chave, xmls):
                     if xml_content:
                         nota['xml_content'] = xml_content
                 
-                notas_processadas.append(nota)
-            
-            # Verifica se há mais páginas
-            pagination = data.get('pagination', {})
-            if page >= pagination.get('total_pages', 1):
-                break
-            
-            page += 1
+                total_notas += len(notas)
+                yield notas
+                
+                # Verifica se há mais páginas: usa total_pages quando informado,
+                # senão uma página incompleta indica que é a última
+                pagination = data.get('pagination') or {}
+                if 'total_pages' in pagination:
+                    if page >= pagination['total_pages']:
+                        break
+                elif len(notas) < self.SYNC_PAGE_SIZE:
+                    break
+                
+                page += 1
         
-        logger.info(f"Sincronização concluída: {len(notas_processadas)} notas processadas")
-        return notas_processadas
+        logger.info(f"Sincronização concluída: {total_notas} notas processadas")
+    
+    def _has_recent_probe(self) -> bool:
+        """Indica se a conexão foi testada com sucesso há menos de PROBE_CACHE_TTL segundos"""
+        ts = MainoAPIService._probe_cache.get(self.base_url)
+        return ts is not None and time.monotonic() - ts < self.PROBE_CACHE_TTL
     
     def test_connection(self) -> bool:
         """
         Testa a conexão com a API do Mainô
         
+        Um resultado positivo é reaproveitado por PROBE_CACHE_TTL segundos,
+        evitando um novo handshake HTTPS em chamadas seguidas.
+        
         Returns:
             bool: True se conexão está funcionando
         """
+        if self._has_recent_probe():
+            return True
+        
         try:
             if self.api_key:
                 # Testa com API Key
                 url = f"{self.base_url}/api/v2/empresas"
-                response = requests.get(url, headers=self._get_headers(), timeout=10)
-                return response.status_code == 200
+                response = self.session.get(url, headers=self._get_headers(), timeout=10)
+                ok = response.status_code == 200
             else:
                 # Testa autenticação OAuth2
-                return self.authenticate()
+                ok = self.authenticate()
                 
         except Exception as e:
             logger.error(f"Erro no teste de conexão: {str(e)}")
             return False
+        
+        if ok:
+            MainoAPIService._probe_cache[self.base_url] = time.monotonic()
+        return ok
 
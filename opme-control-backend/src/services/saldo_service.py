@@ -1,14 +1,107 @@
-from typing import Dict, List, Optional
-from sqlalchemy import and_, or_
-from src.models.nota_fiscal import NotaFiscal, ItemNotaFiscal, SaldoMaterial, db
+import base64
+import gzip
+import io
+import json
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+from lxml import etree
+from sqlalchemy import and_, case, func, insert, lambda_stmt, or_, select, tuple_, update
+from sqlalchemy.orm.attributes import set_committed_value
+from src.cache import cache
+from src.models.nota_fiscal import NotaFiscal, NotaFiscalXML, ItemNotaFiscal, SaldoMaterial, db, normalizar_cnpj
 from src.services.xml_parser import XMLParser
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Colunas da listagem de saldos, na mesma ordem de SaldoMaterial.to_dict()
+_COLUNAS_SALDO = (
+    'id', 'cliente_cnpj', 'cliente_nome', 'codigo_produto', 'descricao_produto',
+    'numero_lote', 'nf_saida_numero', 'nf_saida_serie', 'nf_saida_chave',
+    'quantidade_enviada', 'quantidade_retornada', 'quantidade_utilizada',
+    'quantidade_faturada', 'saldo_disponivel', 'created_at', 'updated_at'
+)
+
+class _LeitorCompactado:
+    """
+    Lê um stream repassando os bytes ao parser e, ao mesmo tempo, os grava
+    comprimidos (gzip); assim o XML original é guardado sem manter uma cópia
+    integral do documento em memória
+    """
+    
+    def __init__(self, stream: IO[bytes]):
+        self._stream = stream
+        self._saida = io.BytesIO()
+        self._gzip = gzip.GzipFile(fileobj=self._saida, mode='wb', compresslevel=6)
+    
+    def read(self, size: int = -1) -> bytes:
+        dados = self._stream.read(size)
+        self._gzip.write(dados)
+        return dados
+    
+    def compactado(self) -> bytes:
+        """Lê o restante do stream e retorna o XML completo comprimido"""
+        while self.read(64 * 1024):
+            pass
+        self._gzip.close()
+        return self._saida.getvalue()
+
+def _saldo_para_dict(row) -> Dict:
+    """Converte uma linha de _COLUNAS_SALDO no mesmo formato de SaldoMaterial.to_dict()"""
+    saldo = dict(zip(_COLUNAS_SALDO, row))
+    for campo in ('created_at', 'updated_at'):
+        if saldo[campo]:
+            saldo[campo] = saldo[campo].isoformat()
+    return saldo
+
+def _produto_cliente(codigo, lote, descricao, enviado, retornado,
+                     utilizado, faturado, saldo) -> Dict:
+    """Monta o produto/lote agrupado da consulta de saldos do cliente"""
+    return {
+        'codigo_produto': codigo,
+        'descricao_produto': descricao,
+        'numero_lote': lote,
+        'nfs_saida': [],
+        'total_enviado': enviado,
+        'total_retornado': retornado,
+        'total_utilizado': utilizado,
+        'total_faturado': faturado,
+        'saldo_total': saldo
+    }
+
+def _encode_cursor_saldo(saldo: Dict) -> str:
+    """Gera o cursor opaco (base64 de JSON) a partir da chave de ordenação do saldo"""
+    chave = [saldo['cliente_nome'], saldo['codigo_produto'], saldo['created_at'], saldo['id']]
+    return base64.urlsafe_b64encode(json.dumps(chave).encode()).decode()
+
+def _decode_cursor_saldo(cursor: str) -> Tuple[str, str, datetime, int]:
+    """Decodifica o cursor de saldos; levanta ValueError se for inválido"""
+    try:
+        nome, codigo, criado_em, saldo_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(nome), str(codigo), datetime.fromisoformat(criado_em), int(saldo_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Cursor inválido')
+
 class SaldoService:
     """Serviço para controle de saldos de materiais OPME"""
     
+    # Itens de nota gravados por INSERT em lote (notas grandes são divididas)
+    ITENS_POR_INSERT = 500
+    
+    # Tratamento de cada tipo de operação no saldo (por nome do método)
+    _DISPATCH = {
+        'saida': '_processar_saida_consignacao',        # Cria novo saldo
+        'retorno': '_processar_retorno_consignacao',    # Atualiza quantidade retornada
+        'simbolico': '_processar_retorno_simbolico',    # Marca como utilizado
+        'faturamento': '_processar_faturamento'         # Marca como faturado
+    }
+    
+    # Colunas gravadas só com dígitos, filtradas sem lower()/ILIKE em filtro_texto
+    _COLUNAS_SO_DIGITOS = frozenset({'cliente_cnpj', 'destinatario_cnpj'})
+    
     @staticmethod
     def processar_nota_fiscal(xml_content: str) -> Dict:
         """
@@ -21,76 +114,57 @@ class SaldoService:
             Dict com resultado do processamento
         """
         try:
+            # Um único parse, compartilhado pela validação e pela extração
+            try:
+                root = XMLParser.parse(xml_content)
+            except etree.XMLSyntaxError as e:
+                return {'success': False, 'error': f"Erro ao fazer parse do XML: {str(e)}"}
+            
             # Valida o XML
-            is_valid, error_msg = XMLParser.validate_xml_structure(xml_content)
+            is_valid, error_msg = XMLParser.validate_root(root)
             if not is_valid:
                 return {'success': False, 'error': error_msg}
             
-            # Faz o parse do XML
-            nf_data = XMLParser.parse_xml(xml_content)
+            nf_data = XMLParser.parse_root(root)
             
-            # Verifica se a nota já foi processada
-            existing_nf = NotaFiscal.query.filter_by(
-                chave_acesso=nf_data['chave_acesso']
-            ).first()
+            return SaldoService._salvar_nota_fiscal(nf_data, xml_content)
             
-            if existing_nf:
-                return {
-                    'success': False, 
-                    'error': f"Nota fiscal {nf_data['numero']}/{nf_data['serie']} já foi processada"
-                }
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Erro ao processar nota fiscal: {str(e)}")
+            return {'success': False, 'error': f"Erro interno: {str(e)}"}
+    
+    @staticmethod
+    def processar_nota_fiscal_stream(stream: IO[bytes]) -> Dict:
+        """
+        Processa uma nota fiscal lida diretamente de um stream (upload)
+        
+        O XML é parseado de forma incremental direto do stream, com os itens
+        extraídos durante o parse; os bytes lidos são comprimidos no caminho
+        para gravar o XML original, sem cópia decodificada do documento.
+        
+        Args:
+            stream: Stream binário com o XML da nota fiscal
             
-            # Cria a nota fiscal no banco
-            nota_fiscal = NotaFiscal(
-                numero=nf_data['numero'],
-                serie=nf_data['serie'],
-                chave_acesso=nf_data['chave_acesso'],
-                data_emissao=nf_data['data_emissao'],
-                cfop=nf_data['cfop'],
-                tipo_operacao=nf_data['tipo_operacao'],
-                destinatario_cnpj=nf_data['destinatario_cnpj'],
-                destinatario_nome=nf_data['destinatario_nome'],
-                xml_content=xml_content
-            )
+        Returns:
+            Dict com resultado do processamento
+        """
+        try:
+            leitor = _LeitorCompactado(stream)
             
-            db.session.add(nota_fiscal)
-            db.session.flush()  # Para obter o ID
+            try:
+                root, itens = XMLParser.parse_stream(leitor)
+            except etree.XMLSyntaxError as e:
+                return {'success': False, 'error': f"Erro ao fazer parse do XML: {str(e)}"}
             
-            # Processa os itens
-            itens_processados = 0
-            for item_data in nf_data['itens']:
-                # Cria o item da nota fiscal
-                item = ItemNotaFiscal(
-                    nota_fiscal_id=nota_fiscal.id,
-                    codigo_produto=item_data['codigo_produto'],
-                    descricao_produto=item_data['descricao_produto'],
-                    quantidade=item_data['quantidade'],
-                    valor_unitario=item_data['valor_unitario'],
-                    valor_total=item_data['valor_total'],
-                    numero_lote=item_data['numero_lote'],
-                    data_fabricacao=item_data['data_fabricacao'],
-                    data_validade=item_data['data_validade']
-                )
-                
-                db.session.add(item)
-                
-                # Atualiza saldos se o item tem lote
-                if item_data['numero_lote']:
-                    SaldoService._atualizar_saldo(
-                        nota_fiscal=nota_fiscal,
-                        item_data=item_data
-                    )
-                    itens_processados += 1
+            # Valida o XML
+            is_valid, error_msg = XMLParser.validate_root(root)
+            if not is_valid:
+                return {'success': False, 'error': error_msg}
             
-            db.session.commit()
+            nf_data = XMLParser.parse_root(root, itens)
             
-            return {
-                'success': True,
-                'message': f"Nota fiscal {nf_data['numero']}/{nf_data['serie']} processada com sucesso",
-                'nota_fiscal_id': nota_fiscal.id,
-                'tipo_operacao': nf_data['tipo_operacao'],
-                'itens_processados': itens_processados
-            }
+            return SaldoService._salvar_nota_fiscal(nf_data, xml_gzip=leitor.compactado())
             
         except Exception as e:
             db.session.rollback()
@@ -98,68 +172,338 @@ class SaldoService:
             return {'success': False, 'error': f"Erro interno: {str(e)}"}
     
     @staticmethod
-    def _atualizar_saldo(nota_fiscal: NotaFiscal, item_data: Dict):
-        """Atualiza o saldo de um material específico"""
+    def _salvar_nota_fiscal(nf_data: Dict, xml_content: str = None, xml_gzip: bytes = None) -> Dict:
+        """
+        Grava uma nota fiscal ainda não processada e faz o commit
         
-        if nota_fiscal.tipo_operacao == 'saida':
-            # Saída para consignação - cria novo saldo
-            SaldoService._processar_saida_consignacao(nota_fiscal, item_data)
+        O XML original vem como texto (xml_content) ou já comprimido (xml_gzip)
+        """
+        
+        # Verifica se a nota já foi processada
+        existing_nf = NotaFiscal.query.filter_by(
+            chave_acesso=nf_data['chave_acesso']
+        ).first()
+        
+        if existing_nf:
+            return {
+                'success': False, 
+                'error': f"Nota fiscal {nf_data['numero']}/{nf_data['serie']} já foi processada"
+            }
+        
+        resultado = SaldoService._registrar_nota_fiscal(nf_data, xml_content, xml_gzip)
+        db.session.commit()
+        SaldoService._invalidar_cache()
+        
+        return resultado
+    
+    @staticmethod
+    def processar_notas_fiscais_bulk(xml_list: List[str]) -> List[Dict]:
+        """
+        Processa um lote de notas fiscais com um único commit
+        
+        Cada nota é gravada dentro de um SAVEPOINT, de modo que uma nota com
+        erro é descartada sem afetar as demais do lote.
+        
+        Args:
+            xml_list: Lista com o conteúdo XML de cada nota fiscal
             
-        elif nota_fiscal.tipo_operacao == 'retorno':
-            # Retorno de consignação - atualiza quantidade retornada
-            SaldoService._processar_retorno_consignacao(nota_fiscal, item_data)
+        Returns:
+            Lista com o resultado de cada nota, na mesma ordem de xml_list
+        """
+        resultados: List[Optional[Dict]] = [None] * len(xml_list)
+        parsed = []
+        
+        # Valida e faz o parse de todas as notas antes de tocar no banco
+        for idx, xml_content in enumerate(xml_list):
+            try:
+                root = XMLParser.parse(xml_content)
+                is_valid, error_msg = XMLParser.validate_root(root)
+                if not is_valid:
+                    resultados[idx] = {'success': False, 'error': error_msg}
+                    continue
+                parsed.append((idx, XMLParser.parse_root(root), xml_content))
+            except etree.XMLSyntaxError as e:
+                resultados[idx] = {'success': False, 'error': f"Erro ao fazer parse do XML: {str(e)}"}
+            except Exception as e:
+                resultados[idx] = {'success': False, 'error': f"Erro interno: {str(e)}"}
+        
+        try:
+            # Uma única consulta para as notas já processadas
+            chaves = [nf_data['chave_acesso'] for _, nf_data, _ in parsed]
+            processadas = {
+                chave for (chave,) in db.session.query(NotaFiscal.chave_acesso).filter(
+                    NotaFiscal.chave_acesso.in_(chaves)
+                )
+            } if chaves else set()
             
-        elif nota_fiscal.tipo_operacao == 'simbolico':
-            # Retorno simbólico - marca como utilizado
-            SaldoService._processar_retorno_simbolico(nota_fiscal, item_data)
+            for idx, nf_data, xml_content in parsed:
+                if nf_data['chave_acesso'] in processadas:
+                    resultados[idx] = {
+                        'success': False,
+                        'error': f"Nota fiscal {nf_data['numero']}/{nf_data['serie']} já foi processada"
+                    }
+                    continue
+                
+                try:
+                    with db.session.begin_nested():
+                        resultados[idx] = SaldoService._registrar_nota_fiscal(nf_data, xml_content)
+                    processadas.add(nf_data['chave_acesso'])
+                except Exception as e:
+                    logger.error(f"Erro ao processar nota fiscal {nf_data['chave_acesso']}: {str(e)}")
+                    resultados[idx] = {'success': False, 'error': f"Erro interno: {str(e)}"}
+            
+            db.session.commit()
+            SaldoService._invalidar_cache()
             
-        elif nota_fiscal.tipo_operacao == 'faturamento':
-            # Faturamento - marca como faturado
-            SaldoService._processar_faturamento(nota_fiscal, item_data)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Erro ao gravar lote de notas fiscais: {str(e)}")
+            erro = {'success': False, 'error': f"Erro interno: {str(e)}"}
+            resultados = [
+                erro if resultado is None or resultado['success'] else resultado
+                for resultado in resultados
+            ]
+        
+        return resultados
     
     @staticmethod
-    def _processar_saida_consignacao(nota_fiscal: NotaFiscal, item_data: Dict):
-        """Processa saída para consignação"""
-        
-        # Verifica se já existe saldo para este item
-        saldo = SaldoMaterial.query.filter_by(
-            cliente_cnpj=nota_fiscal.destinatario_cnpj,
-            codigo_produto=item_data['codigo_produto'],
-            numero_lote=item_data['numero_lote'],
-            nf_saida_chave=nota_fiscal.chave_acesso
-        ).first()
+    def _invalidar_cache():
+        """Descarta respostas em cache que dependem das notas fiscais e saldos"""
+        try:
+            cache.clear()
+        except Exception as e:
+            # Falha no cache não deve desfazer uma nota já gravada
+            logger.warning(f"Erro ao invalidar cache: {str(e)}")
+    
+    @staticmethod
+    def _registrar_nota_fiscal(nf_data: Dict, xml_content: str = None, xml_gzip: bytes = None) -> Dict:
+        """
+        Grava a nota fiscal e seus itens e atualiza os saldos, sem commit
         
-        if saldo:
-            # Atualiza quantidade enviada
-            saldo.quantidade_enviada += item_data['quantidade']
-        else:
-            # Cria novo saldo
-            saldo = SaldoMaterial(
-                cliente_cnpj=nota_fiscal.destinatario_cnpj,
-                cliente_nome=nota_fiscal.destinatario_nome,
-                codigo_produto=item_data['codigo_produto'],
-                descricao_produto=item_data['descricao_produto'],
-                numero_lote=item_data['numero_lote'],
-                nf_saida_numero=nota_fiscal.numero,
-                nf_saida_serie=nota_fiscal.serie,
-                nf_saida_chave=nota_fiscal.chave_acesso,
-                quantidade_enviada=item_data['quantidade']
-            )
-            db.session.add(saldo)
+        Returns:
+            Dict com resultado do processamento
+        """
+        nota_fiscal = NotaFiscal(
+            numero=nf_data['numero'],
+            serie=nf_data['serie'],
+            chave_acesso=nf_data['chave_acesso'],
+            data_emissao=nf_data['data_emissao'],
+            cfop=nf_data['cfop'],
+            tipo_operacao=nf_data['tipo_operacao'],
+            destinatario_cnpj=nf_data['destinatario_cnpj'],
+            destinatario_nome=nf_data['destinatario_nome'],
+            xml=NotaFiscalXML(chave_acesso=nf_data['chave_acesso'], xml_content=xml_content, xml_gzip=xml_gzip)
+        )
+        
+        db.session.add(nota_fiscal)
+        db.session.flush()  # Para obter o ID
+        
+        # CFOPs fora do mapeamento ('outros') só gravam os itens, sem
+        # consultar nem movimentar saldos
+        movimenta_saldo = nota_fiscal.tipo_operacao != 'outros'
+        
+        # Saldos movimentados pela nota, carregados de uma vez
+        saldos = SaldoService._carregar_saldos_nota(nota_fiscal, nf_data['itens']) if movimenta_saldo else {}
+        
+        # Itens (em blocos de ITENS_POR_INSERT), saldos novos e quantidades
+        # movimentadas são gravados em lote, sem passar pela unit of work do ORM
+        itens = []
+        novos_saldos = {}
+        movimentos = defaultdict(dict)
+        itens_processados = 0
+        try:
+            # Nada a gravar pela unit of work durante o laço: os saldos já foram
+            # carregados e as gravações são em lote, então o autoflush fica desligado
+            with db.session.no_autoflush:
+                for item_data in nf_data['itens']:
+                    itens.append({
+                        'nota_fiscal_id': nota_fiscal.id,
+                        'codigo_produto': item_data['codigo_produto'],
+                        'descricao_produto': item_data['descricao_produto'],
+                        'quantidade': item_data['quantidade'],
+                        'valor_unitario': item_data['valor_unitario'],
+                        'valor_total': item_data['valor_total'],
+                        'numero_lote': item_data['numero_lote'],
+                        'data_fabricacao': item_data['data_fabricacao'],
+                        'data_validade': item_data['data_validade']
+                    })
+                    
+                    # Atualiza saldos se o item tem lote
+                    if item_data['numero_lote']:
+                        novo_saldo = SaldoService._atualizar_saldo(
+                            nota_fiscal=nota_fiscal,
+                            item_data=item_data,
+                            saldos=saldos,
+                            movimentos=movimentos
+                        ) if movimenta_saldo else None
+                        if novo_saldo:
+                            # Itens repetidos (mesmo produto/lote) somam no mesmo saldo
+                            chave = (novo_saldo['codigo_produto'], novo_saldo['numero_lote'])
+                            if chave in novos_saldos:
+                                novos_saldos[chave]['quantidade_enviada'] += novo_saldo['quantidade_enviada']
+                            else:
+                                novos_saldos[chave] = novo_saldo
+                        itens_processados += 1
+                    
+                    if len(itens) >= SaldoService.ITENS_POR_INSERT:
+                        db.session.execute(insert(ItemNotaFiscal), itens)
+                        itens.clear()
+                
+                if itens:
+                    db.session.execute(insert(ItemNotaFiscal), itens)
+                if novos_saldos:
+                    db.session.execute(insert(SaldoMaterial), list(novos_saldos.values()))
+                
+                # Um único UPDATE por coluna movimentada para toda a nota: o banco
+                # soma a quantidade de cada saldo (CASE id WHEN ... THEN ...)
+                saldos_tabela = SaldoMaterial.__table__
+                for coluna, quantidades in movimentos.items():
+                    deltas = {saldo.id: quantidade for saldo, quantidade in quantidades.items()}
+                    db.session.execute(
+                        update(saldos_tabela)
+                        .where(saldos_tabela.c.id.in_(deltas))
+                        .values({coluna: saldos_tabela.c[coluna]
+                                 + case(deltas, value=saldos_tabela.c.id, else_=0)})
+                    )
+        except Exception:
+            # Os saldos carregados já refletem as quantidades da nota; se ela
+            # for descartada, voltam a ser lidos do banco
+            for quantidades in movimentos.values():
+                for saldo in quantidades:
+                    db.session.expire(saldo)
+            raise
+        
+        return {
+            'success': True,
+            'message': f"Nota fiscal {nf_data['numero']}/{nf_data['serie']} processada com sucesso",
+            'nota_fiscal_id': nota_fiscal.id,
+            'tipo_operacao': nf_data['tipo_operacao'],
+            'itens_processados': itens_processados
+        }
+    
+    @staticmethod
+    def _atualizar_saldo(nota_fiscal: NotaFiscal, item_data: Dict,
+                         saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                         movimentos: Dict[str, Dict[SaldoMaterial, float]]) -> Optional[Dict]:
+        """
+        Atualiza o saldo de um material específico
+        
+        Args:
+            saldos: Saldos da nota já carregados por _carregar_saldos_nota
+            movimentos: Quantidades somadas aos saldos existentes, por coluna,
+                gravadas em lote pelo chamador
+            
+        Returns:
+            Dados do saldo a ser criado (saída sem saldo existente) ou None
+        """
+        handler = SaldoService._DISPATCH.get(nota_fiscal.tipo_operacao)
+        if handler is None:
+            return None
+        
+        # Só a saída retorna dados (saldo a criar); os demais alteram o saldo carregado
+        return getattr(SaldoService, handler)(nota_fiscal, item_data, saldos, movimentos)
     
     @staticmethod
-    def _processar_retorno_consignacao(nota_fiscal: NotaFiscal, item_data: Dict):
+    def _carregar_saldos_nota(nota_fiscal: NotaFiscal,
+                              itens: List[Dict]) -> Dict[Tuple[str, str], List[SaldoMaterial]]:
+        """
+        Busca em uma única consulta os saldos que os itens da nota podem movimentar
+        
+        Nos retornos, simbólicos e faturamentos, os saldos com quantidade
+        disponível, do mais antigo para o mais recente. A saída não consulta o
+        banco: a nota acabou de ser registrada (notas repetidas são recusadas
+        antes), então ainda não há saldos com a sua chave.
+        
+        Returns:
+            Saldos agrupados por (codigo_produto, numero_lote)
+        """
+        saldos = defaultdict(list)
+        if nota_fiscal.tipo_operacao == 'saida':
+            return saldos
+        
+        chaves = {
+            (item['codigo_produto'], item['numero_lote'])
+            for item in itens if item['numero_lote']
+        }
+        if not chaves:
+            return saldos
+        
+        query = select(SaldoMaterial).where(
+            SaldoMaterial.cliente_cnpj == nota_fiscal.destinatario_cnpj,
+            tuple_(SaldoMaterial.codigo_produto, SaldoMaterial.numero_lote).in_(chaves),
+            # Só considera saldos com quantidade disponível
+            SaldoMaterial.saldo_disponivel > 0
+        ).order_by(SaldoMaterial.created_at.asc(), SaldoMaterial.id.asc())
+        
+        for saldo in db.session.execute(query).scalars():
+            saldos[(saldo.codigo_produto, saldo.numero_lote)].append(saldo)
+        return saldos
+    
+    @staticmethod
+    def _saldo_disponivel_nota(saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                               codigo_produto: str, numero_lote: str) -> Optional[SaldoMaterial]:
+        """
+        Primeiro saldo carregado que ainda tem quantidade disponível
+        
+        Considera as baixas feitas pelos itens anteriores da mesma nota.
+        """
+        for saldo in saldos.get((codigo_produto, numero_lote), ()):
+            if saldo.saldo_disponivel > 0:
+                return saldo
+        return None
+    
+    @staticmethod
+    def _movimentar_saldo(saldo: SaldoMaterial, coluna: str, quantidade: float,
+                          movimentos: Dict[str, Dict[SaldoMaterial, float]]):
+        """
+        Soma a quantidade no saldo carregado e registra o movimento
+        
+        O objeto é alterado sem ficar pendente de flush, para que os itens
+        seguintes da nota vejam o saldo atualizado; a gravação fica com o
+        UPDATE em lote de _registrar_nota_fiscal.
+        """
+        set_committed_value(saldo, coluna, getattr(saldo, coluna) + quantidade)
+        movimentos[coluna][saldo] = movimentos[coluna].get(saldo, 0) + quantidade
+    
+    @staticmethod
+    def _processar_saida_consignacao(nota_fiscal: NotaFiscal, item_data: Dict,
+                                     saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                                     movimentos: Dict[str, Dict[SaldoMaterial, float]]) -> Dict:
+        """
+        Processa saída para consignação
+        
+        Returns:
+            Dados do novo saldo, para inserção em lote pelo chamador (que soma
+            em memória os itens repetidos do mesmo produto/lote)
+        """
+        # Novo saldo (a inserção em lote não passa pelo @validates do modelo)
+        return {
+            'cliente_cnpj': normalizar_cnpj(nota_fiscal.destinatario_cnpj),
+            'cliente_nome': nota_fiscal.destinatario_nome,
+            'codigo_produto': item_data['codigo_produto'],
+            'descricao_produto': item_data['descricao_produto'],
+            'numero_lote': item_data['numero_lote'],
+            'nf_saida_numero': nota_fiscal.numero,
+            'nf_saida_serie': nota_fiscal.serie,
+            'nf_saida_chave': nota_fiscal.chave_acesso,
+            'quantidade_enviada': item_data['quantidade']
+        }
+    
+    @staticmethod
+    def _processar_retorno_consignacao(nota_fiscal: NotaFiscal, item_data: Dict,
+                                       saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                                       movimentos: Dict[str, Dict[SaldoMaterial, float]]):
         """Processa retorno de consignação"""
         
         # Busca o saldo correspondente
-        saldo = SaldoService._buscar_saldo_para_retorno(
-            nota_fiscal.destinatario_cnpj,
+        saldo = SaldoService._saldo_disponivel_nota(
+            saldos,
             item_data['codigo_produto'],
             item_data['numero_lote']
         )
         
         if saldo:
-            saldo.quantidade_retornada += item_data['quantidade']
+            SaldoService._movimentar_saldo(saldo, 'quantidade_retornada', item_data['quantidade'], movimentos)
         else:
             logger.warning(
                 f"Saldo não encontrado para retorno: "
@@ -169,18 +513,20 @@ class SaldoService:
             )
     
     @staticmethod
-    def _processar_retorno_simbolico(nota_fiscal: NotaFiscal, item_data: Dict):
+    def _processar_retorno_simbolico(nota_fiscal: NotaFiscal, item_data: Dict,
+                                     saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                                     movimentos: Dict[str, Dict[SaldoMaterial, float]]):
         """Processa retorno simbólico (material utilizado)"""
         
         # Busca o saldo correspondente
-        saldo = SaldoService._buscar_saldo_para_retorno(
-            nota_fiscal.destinatario_cnpj,
+        saldo = SaldoService._saldo_disponivel_nota(
+            saldos,
             item_data['codigo_produto'],
             item_data['numero_lote']
         )
         
         if saldo:
-            saldo.quantidade_utilizada += item_data['quantidade']
+            SaldoService._movimentar_saldo(saldo, 'quantidade_utilizada', item_data['quantidade'], movimentos)
         else:
             logger.warning(
                 f"Saldo não encontrado para retorno simbólico: "
@@ -190,18 +536,20 @@ class SaldoService:
             )
     
     @staticmethod
-    def _processar_faturamento(nota_fiscal: NotaFiscal, item_data: Dict):
+    def _processar_faturamento(nota_fiscal: NotaFiscal, item_data: Dict,
+                               saldos: Dict[Tuple[str, str], List[SaldoMaterial]],
+                               movimentos: Dict[str, Dict[SaldoMaterial, float]]):
         """Processa faturamento do material utilizado"""
         
         # Busca o saldo correspondente
-        saldo = SaldoService._buscar_saldo_para_retorno(
-            nota_fiscal.destinatario_cnpj,
+        saldo = SaldoService._saldo_disponivel_nota(
+            saldos,
             item_data['codigo_produto'],
             item_data['numero_lote']
         )
         
         if saldo:
-            saldo.quantidade_faturada += item_data['quantidade']
+            SaldoService._movimentar_saldo(saldo, 'quantidade_faturada', item_data['quantidade'], movimentos)
         else:
             logger.warning(
                 f"Saldo não encontrado para faturamento: "
@@ -216,89 +564,429 @@ class SaldoService:
         """
         Busca saldo para operações de retorno/utilização
         Prioriza saldos com quantidade disponível
+        
+        Usada por validar_operacao; a importação de notas usa os saldos
+        carregados de uma vez por _carregar_saldos_nota.
         """
-        return SaldoMaterial.query.filter(
-            and_(
+        return db.session.execute(
+            select(SaldoMaterial).where(
                 SaldoMaterial.cliente_cnpj == cliente_cnpj,
                 SaldoMaterial.codigo_produto == codigo_produto,
                 SaldoMaterial.numero_lote == numero_lote,
                 # Só considera saldos com quantidade disponível
-                SaldoMaterial.quantidade_enviada > 
-                (SaldoMaterial.quantidade_retornada + SaldoMaterial.quantidade_utilizada)
-            )
-        ).order_by(SaldoMaterial.created_at.asc()).first()
+                SaldoMaterial.saldo_disponivel > 0
+            ).order_by(SaldoMaterial.created_at.asc()).limit(1)
+        ).scalars().first()
     
     @staticmethod
-    def consultar_saldos_cliente(cliente_cnpj: str = None, cliente_nome: str = None) -> List[Dict]:
+    def consultar_saldos_cliente(cliente_cnpj: str = None, cliente_nome: str = None,
+                                 limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
         """
         Consulta saldos de um cliente específico
         
         Args:
             cliente_cnpj: CNPJ do cliente
             cliente_nome: Nome do cliente (busca parcial)
+            limit: Máximo de saldos retornados (None para todos)
+            offset: Saldos a pular, para buscar as páginas seguintes
             
         Returns:
             Lista de saldos do cliente
         """
-        query = SaldoMaterial.query
+        # Mesmas colunas, filtros e ordenação da consulta de saldos, em tuplas
+        query = SaldoService._query_saldos({
+            'cliente_cnpj': cliente_cnpj,
+            'cliente_nome': cliente_nome
+        })
+        if limit is not None:
+            query = query.limit(limit).offset(offset)
+        
+        return [_saldo_para_dict(saldo) for saldo in query]
+    
+    @staticmethod
+    def iterar_saldos_cliente_agrupado(cliente_cnpj: str, incluir_nfs: bool = True,
+                                       batch_size: int = 500) -> Iterator[Tuple[str, int, Dict]]:
+        """
+        Percorre os saldos de um cliente agrupados por produto e lote, um grupo por vez
+        
+        Sem o detalhe por NF, os totais são somados no banco (GROUP BY). Com o
+        detalhe, uma única consulta traz cada NF de saída já acompanhada dos
+        totais do seu grupo (funções de janela), ordenada de forma que as NFs
+        de um mesmo produto/lote cheguem contíguas; cada grupo é emitido assim
+        que termina, sem manter os demais em memória.
+        
+        Args:
+            cliente_cnpj: CNPJ do cliente (somente dígitos)
+            incluir_nfs: Se True, inclui a lista de NFs de saída de cada produto
+            batch_size: Quantidade de linhas buscadas por vez no banco
+            
+        Yields:
+            Tuplas (nome do cliente, NFs do grupo, produto)
+        """
+        grupo = (SaldoMaterial.codigo_produto, SaldoMaterial.numero_lote)
+        
+        if not incluir_nfs:
+            grupos = db.session.query(
+                *grupo,
+                func.max(SaldoMaterial.descricao_produto),
+                func.min(SaldoMaterial.cliente_nome),
+                func.sum(SaldoMaterial.quantidade_enviada),
+                func.sum(SaldoMaterial.quantidade_retornada),
+                func.sum(SaldoMaterial.quantidade_utilizada),
+                func.sum(SaldoMaterial.quantidade_faturada),
+                func.sum(SaldoMaterial.saldo_disponivel),
+                func.count(SaldoMaterial.id)
+            ).filter(
+                SaldoMaterial.cliente_cnpj == cliente_cnpj
+            ).group_by(*grupo).order_by(
+                SaldoMaterial.codigo_produto,
+                func.max(SaldoMaterial.created_at).desc(),
+                SaldoMaterial.numero_lote
+            ).yield_per(batch_size)
+            
+            for codigo, lote, descricao, nome, *totais, nfs_grupo in grupos:
+                yield nome, nfs_grupo, _produto_cliente(codigo, lote, descricao, *totais)
+            return
         
-        if cliente_cnpj:
-            # Remove caracteres especiais do CNPJ
-            cliente_cnpj = ''.join(filter(str.isdigit, cliente_cnpj))
+        def total(coluna):
+            return func.sum(coluna).over(partition_by=grupo)
+        
+        # Mesma ordem dos grupos acima; dentro do grupo, NFs mais recentes primeiro
+        linhas = db.session.query(
+            *grupo,
+            func.max(SaldoMaterial.descricao_produto).over(partition_by=grupo),
+            func.min(SaldoMaterial.cliente_nome).over(partition_by=grupo),
+            total(SaldoMaterial.quantidade_enviada),
+            total(SaldoMaterial.quantidade_retornada),
+            total(SaldoMaterial.quantidade_utilizada),
+            total(SaldoMaterial.quantidade_faturada),
+            total(SaldoMaterial.saldo_disponivel),
+            func.count(SaldoMaterial.id).over(partition_by=grupo),
+            SaldoMaterial.nf_saida_numero,
+            SaldoMaterial.nf_saida_serie,
+            SaldoMaterial.nf_saida_chave,
+            SaldoMaterial.quantidade_enviada,
+            SaldoMaterial.quantidade_retornada,
+            SaldoMaterial.quantidade_utilizada,
+            SaldoMaterial.quantidade_faturada,
+            SaldoMaterial.saldo_disponivel
+        ).filter(
+            SaldoMaterial.cliente_cnpj == cliente_cnpj
+        ).order_by(
+            SaldoMaterial.codigo_produto,
+            func.max(SaldoMaterial.created_at).over(partition_by=grupo).desc(),
+            SaldoMaterial.numero_lote,
+            SaldoMaterial.created_at.desc(),
+            SaldoMaterial.id.desc()
+        ).yield_per(batch_size)
+        
+        for _, nfs in groupby(linhas, key=itemgetter(0, 1)):
+            produto = None
+            for linha in nfs:
+                codigo, lote, descricao, nome = linha[:4]
+                nfs_grupo = linha[9]
+                numero, serie, chave, enviada, retornada, utilizada, faturada, saldo = linha[10:]
+                if produto is None:
+                    produto = _produto_cliente(codigo, lote, descricao, *linha[4:9])
+                produto['nfs_saida'].append({
+                    'nf_numero': numero,
+                    'nf_serie': serie,
+                    'nf_chave': chave,
+                    'quantidade_enviada': enviada,
+                    'quantidade_retornada': retornada,
+                    'quantidade_utilizada': utilizada,
+                    'quantidade_faturada': faturada,
+                    'saldo_disponivel': saldo
+                })
+            yield nome, nfs_grupo, produto
+    
+    @staticmethod
+    def filtro_texto(coluna, termo: str, padrao: str = 'contem'):
+        """
+        Monta o filtro de texto mais específico para o termo informado
+        
+        Um '%' explícito no início e/ou no fim do termo define o tipo de busca
+        ('abc%' prefixo, '%abc' sufixo, '%abc%' substring); sem '%', vale o
+        `padrao` do chamador: 'igual' (igualdade, usa índice btree), 'prefixo'
+        (lower(coluna) LIKE 'abc%', coberto pelos índices text_pattern_ops)
+        ou 'contem' (ILIKE '%abc%', coberto pelos índices trigram).
+        
+        Colunas só com dígitos (CNPJ/CPF) não têm maiúsculas/minúsculas: usam
+        LIKE direto sobre a coluna, sem lower()/ILIKE, para aproveitar os
+        índices da coluna crua.
+        """
+        inicio, fim = termo.startswith('%'), termo.endswith('%') and len(termo) > 1
+        if inicio or fim:
+            termo = termo.strip('%')
+            padrao = 'contem' if inicio and fim else ('sufixo' if inicio else 'prefixo')
+        
+        if padrao == 'igual':
+            return coluna == termo
+        if coluna.key in SaldoService._COLUNAS_SO_DIGITOS:
+            if padrao == 'prefixo':
+                return coluna.like(f'{termo}%')
+            if padrao == 'sufixo':
+                return coluna.like(f'%{termo}')
+            return coluna.like(f'%{termo}%')
+        if padrao == 'prefixo':
+            return func.lower(coluna).like(f'{termo.lower()}%')
+        if padrao == 'sufixo':
+            return coluna.ilike(f'%{termo}')
+        return coluna.ilike(f'%{termo}%')
+    
+    @staticmethod
+    def _aplicar_filtros(query, filtros: Dict):
+        """
+        Aplica à query os filtros da consulta/exportação de saldos
+        
+        Args:
+            query: Query com SaldoMaterial como entidade principal
+            filtros: Dict com cliente_cnpj, cliente_nome, codigo_produto,
+                     data_inicio, data_fim (DD/MM/YYYY) e cfop
+        """
+        if filtros.get('cliente_cnpj'):
+            cliente_cnpj = normalizar_cnpj(filtros['cliente_cnpj'])
             query = query.filter(SaldoMaterial.cliente_cnpj == cliente_cnpj)
         
-        if cliente_nome:
+        if filtros.get('cliente_nome'):
             query = query.filter(
-                SaldoMaterial.cliente_nome.ilike(f'%{cliente_nome}%')
+                SaldoService.filtro_texto(SaldoMaterial.cliente_nome, filtros['cliente_nome'])
+            )
+        
+        if filtros.get('codigo_produto'):
+            query = query.filter(
+                or_(
+                    SaldoService.filtro_texto(SaldoMaterial.codigo_produto, filtros['codigo_produto']),
+                    SaldoService.filtro_texto(SaldoMaterial.descricao_produto, filtros['codigo_produto'])
+                )
             )
         
-        # Ordena por cliente, produto e data
-        saldos = query.order_by(
+        # Período e CFOP referem-se à NF de saída que originou o saldo
+        if filtros.get('data_inicio') or filtros.get('data_fim') or filtros.get('cfop'):
+            query = query.join(
+                NotaFiscal, NotaFiscal.chave_acesso == SaldoMaterial.nf_saida_chave
+            )
+            if filtros.get('data_inicio'):
+                data_inicio = datetime.strptime(filtros['data_inicio'], '%d/%m/%Y')
+                query = query.filter(NotaFiscal.data_emissao >= data_inicio)
+            if filtros.get('data_fim'):
+                data_fim = datetime.strptime(filtros['data_fim'], '%d/%m/%Y')
+                query = query.filter(NotaFiscal.data_emissao < data_fim + timedelta(days=1))
+            if filtros.get('cfop'):
+                query = query.filter(NotaFiscal.cfop == filtros['cfop'])
+        
+        return query
+    
+    @staticmethod
+    def _query_saldos(filtros: Dict):
+        """
+        Monta a query ordenada de saldos aplicando os filtros
+        
+        Seleciona apenas as colunas (tuplas), sem hidratar objetos do ORM;
+        use _saldo_para_dict para montar cada linha.
+        """
+        query = db.session.query(
+            *(getattr(SaldoMaterial, coluna) for coluna in _COLUNAS_SALDO)
+        ).select_from(SaldoMaterial)
+        query = SaldoService._aplicar_filtros(query, filtros)
+        
+        return query.order_by(
             SaldoMaterial.cliente_nome,
             SaldoMaterial.codigo_produto,
-            SaldoMaterial.created_at.desc()
-        ).all()
+            SaldoMaterial.created_at.desc(),
+            SaldoMaterial.id.desc()
+        )
+    
+    @staticmethod
+    def contar_por_status(filtros: Dict) -> Dict:
+        """
+        Conta os saldos filtrados por status em uma única consulta agregada
+        
+        Returns:
+            Dict com total, positivos, zerados e negativos
+        """
+        saldo = SaldoMaterial.saldo_disponivel
         
-        return [saldo.to_dict() for saldo in saldos]
+        query = db.session.query(
+            func.count(SaldoMaterial.id),
+            func.sum(case((saldo > 0, 1), else_=0)),
+            func.sum(case((saldo == 0, 1), else_=0)),
+            func.sum(case((saldo < 0, 1), else_=0))
+        ).select_from(SaldoMaterial)
+        
+        total, positivos, zerados, negativos = SaldoService._aplicar_filtros(query, filtros).one()
+        
+        return {
+            'total': total or 0,
+            'positivos': positivos or 0,
+            'zerados': zerados or 0,
+            'negativos': negativos or 0
+        }
     
     @staticmethod
-    def consultar_saldos_produto(codigo_produto: str) -> List[Dict]:
-        """Consulta saldos de um produto específico"""
-        saldos = SaldoMaterial.query.filter(
-            SaldoMaterial.codigo_produto.ilike(f'%{codigo_produto}%')
+    def consultar_saldos(filtros: Dict, page: int = 1, per_page: int = 20) -> Dict:
+        """
+        Consulta saldos com filtros e paginação
+        
+        Returns:
+            Dict com a lista de saldos ('data') e dados de paginação
+        """
+        saldos = SaldoService._query_saldos(filtros).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
+        
+        return {
+            'data': [_saldo_para_dict(saldo) for saldo in saldos.items],
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'total': saldos.total,
+                'pages': saldos.pages,
+                'has_next': saldos.has_next,
+                'has_prev': saldos.has_prev
+            }
+        }
+    
+    @staticmethod
+    def consultar_saldos_cursor(filtros: Dict, cursor: str = None, per_page: int = 20,
+                                incluir_total: bool = False) -> Dict:
+        """
+        Consulta saldos com paginação por keyset (sem OFFSET nem COUNT)
+        
+        O cursor identifica a última linha da página anterior pela chave de
+        ordenação (cliente_nome, codigo_produto, created_at DESC, id DESC).
+        
+        Args:
+            filtros: Mesmos filtros de consultar_saldos
+            cursor: `next_cursor` da página anterior (None/vazio para a primeira)
+            per_page: Itens por página
+            incluir_total: Se True, inclui a contagem total (custa um COUNT)
+            
+        Returns:
+            Dict com a lista de saldos ('data') e dados de paginação
+            
+        Raises:
+            ValueError: Se o cursor for inválido
+        """
+        query = SaldoService._query_saldos(filtros)
+        
+        if cursor:
+            nome, codigo, criado_em, saldo_id = _decode_cursor_saldo(cursor)
+            # Expansão da comparação de tuplas, já que as direções da ordenação diferem
+            query = query.filter(or_(
+                SaldoMaterial.cliente_nome > nome,
+                and_(SaldoMaterial.cliente_nome == nome, SaldoMaterial.codigo_produto > codigo),
+                and_(SaldoMaterial.cliente_nome == nome, SaldoMaterial.codigo_produto == codigo,
+                     SaldoMaterial.created_at < criado_em),
+                and_(SaldoMaterial.cliente_nome == nome, SaldoMaterial.codigo_produto == codigo,
+                     SaldoMaterial.created_at == criado_em, SaldoMaterial.id < saldo_id)
+            ))
+        
+        # Uma linha a mais indica se existe próxima página
+        saldos = [_saldo_para_dict(saldo) for saldo in query.limit(per_page + 1)]
+        has_next = len(saldos) > per_page
+        saldos = saldos[:per_page]
+        
+        pagination = {
+            'per_page': per_page,
+            'has_next': has_next,
+            'next_cursor': _encode_cursor_saldo(saldos[-1]) if has_next else None
+        }
+        if incluir_total:
+            pagination['total'] = SaldoService.contar_por_status(filtros)['total']
+        
+        return {'data': saldos, 'pagination': pagination}
+    
+    @staticmethod
+    def iterar_saldos(filtros: Dict, batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        Percorre os saldos filtrados em lotes, sem carregar o resultado inteiro
+        
+        Usado pelas exportações para manter a memória constante em relação
+        ao número de linhas.
+        """
+        for saldo in SaldoService._query_saldos(filtros).yield_per(batch_size):
+            yield _saldo_para_dict(saldo)
+    
+    @staticmethod
+    def consultar_saldos_produto(codigo_produto: str, limit: Optional[int] = None,
+                                 offset: int = 0, exato: bool = False) -> List[Dict]:
+        """
+        Consulta saldos de um produto específico
+        
+        O código informado é buscado por substring; com `exato`, por
+        igualdade (usa índice btree). '%' explícito (ex.: 'P1%') define
+        prefixo ou sufixo. Com `limit`, retorna só a página pedida (a partir
+        de `offset`).
+        """
+        query = db.session.query(
+            *(getattr(SaldoMaterial, coluna) for coluna in _COLUNAS_SALDO)
+        ).filter(
+            SaldoService.filtro_texto(SaldoMaterial.codigo_produto, codigo_produto,
+                                     'igual' if exato else 'contem')
         ).order_by(
             SaldoMaterial.cliente_nome,
-            SaldoMaterial.created_at.desc()
-        ).all()
+            SaldoMaterial.created_at.desc(),
+            SaldoMaterial.id.desc()
+        )
+        if limit is not None:
+            query = query.limit(limit).offset(offset)
         
-        return [saldo.to_dict() for saldo in saldos]
+        # Tuplas convertidas direto no formato de to_dict(), sem objetos do ORM
+        return [_saldo_para_dict(saldo) for saldo in query]
     
     @staticmethod
     def obter_resumo_saldos() -> Dict:
-        """Obtém resumo geral dos saldos"""
-        
-        # Total de clientes com saldo
-        total_clientes = db.session.query(SaldoMaterial.cliente_cnpj).distinct().count()
-        
-        # Total de produtos em consignação
-        total_produtos = db.session.query(SaldoMaterial.codigo_produto).distinct().count()
+        """
+        Obtém resumo geral dos saldos
         
-        # Saldos com pendências (quantidade disponível > 0)
-        saldos_pendentes = SaldoMaterial.query.filter(
-            SaldoMaterial.quantidade_enviada > 
-            (SaldoMaterial.quantidade_retornada + SaldoMaterial.quantidade_utilizada)
-        ).count()
+        Os totais saem de uma única consulta agregada; o total de notas
+        fiscais vem na mesma consulta, como subconsulta escalar.
+        """
+        total_nfs = select(func.count(NotaFiscal.id)).scalar_subquery()
         
-        # Total de notas fiscais processadas
-        total_nfs = NotaFiscal.query.count()
+        (total_clientes, total_produtos,
+         saldos_pendentes, total_nfs) = db.session.query(
+            # Total de clientes com saldo
+            func.count(SaldoMaterial.cliente_cnpj.distinct()),
+            # Total de produtos em consignação
+            func.count(SaldoMaterial.codigo_produto.distinct()),
+            # Saldos com pendências (quantidade disponível > 0)
+            func.sum(case((SaldoMaterial.saldo_disponivel > 0, 1), else_=0)),
+            # Total de notas fiscais processadas
+            total_nfs
+        ).select_from(SaldoMaterial).one()
         
         return {
             'total_clientes': total_clientes,
             'total_produtos': total_produtos,
-            'saldos_pendentes': saldos_pendentes,
+            'saldos_pendentes': saldos_pendentes or 0,
             'total_nfs_processadas': total_nfs
         }
     
+    @staticmethod
+    def listar_saldos_criticos(limite: int = 10, maximo: float = 5) -> List[Dict]:
+        """
+        Lista os saldos positivos com até `maximo` unidades disponíveis
+        
+        A faixa e a ordenação usam a expressão do saldo disponível, coberta
+        pelo índice ix_saldos_saldo_disp; as linhas já saem como dicts.
+        """
+        criticos = db.session.execute(lambda_stmt(
+            lambda: select(
+                SaldoMaterial.cliente_nome,
+                SaldoMaterial.codigo_produto,
+                SaldoMaterial.descricao_produto,
+                SaldoMaterial.numero_lote,
+                SaldoMaterial.saldo_disponivel.label('saldo_disponivel')
+            ).where(
+                SaldoMaterial.saldo_disponivel > 0,
+                SaldoMaterial.saldo_disponivel <= maximo
+            ).order_by(SaldoMaterial.saldo_disponivel).limit(limite)
+        )).mappings()
+        
+        return [dict(row) for row in criticos]
+    
     @staticmethod
     def validar_operacao(nota_fiscal: NotaFiscal, item_data: Dict) -> Dict:
         """
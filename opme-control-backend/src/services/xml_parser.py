@@ -1,7 +1,28 @@
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime
+from typing import IO, Dict, List, Optional, Tuple
 import re
+from lxml import etree
+
+# Parser do lxml (em C) compartilhado; o XML é sempre tratado como UTF-8, como
+# exige a NFe, e entidades externas não são resolvidas
+_PARSER = etree.XMLParser(encoding='utf-8', resolve_entities=False, no_network=True)
+
+# Tabela para str.translate que remove todo caractere ASCII que não é dígito
+_NAO_DIGITOS_ASCII = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+def _parse_data(valor: str) -> Optional[date]:
+    """
+    Converte uma data 'AAAA-MM-DD' do XML em date (None se inválida)
+    
+    O formato do leiaute vai direto para date.fromisoformat (em C); outras
+    grafias aceitas pelo strptime (ex.: mês sem zero) seguem por ele.
+    """
+    try:
+        if len(valor) == 10 and valor[4] == valor[7] == '-':
+            return date.fromisoformat(valor)
+        return datetime.strptime(valor, '%Y-%m-%d').date()
+    except ValueError:
+        return None
 
 class XMLParser:
     """Classe para processar XMLs de Notas Fiscais"""
@@ -18,6 +39,17 @@ class XMLParser:
         '6114': 'faturamento'  # Faturamento do material utilizado (fora do estado)
     }
     
+    # Padrões de lote em infAdProd, como "LOTE: 123456", "Lote: 123456", "L: 123456"
+    # (compilados uma vez; testados nesta ordem)
+    _LOTE_PATTERNS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+        r'lote[:\s]+([^\s,;\.]+)',  # LOTE: 123456
+        r'l[:\s]+([^\s,;\.]+)',     # L: 123456
+        r'lot[:\s]+([^\s,;\.]+)',   # LOT: 123456
+        r'batch[:\s]+([^\s,;\.]+)', # BATCH: 123456
+        r'nr[:\s]*lote[:\s]+([^\s,;\.]+)', # NR LOTE: 123456
+        r'numero[:\s]*lote[:\s]+([^\s,;\.]+)' # NUMERO LOTE: 123456
+    ))
+    
     @staticmethod
     def parse_xml(xml_content: str) -> Dict:
         """
@@ -30,62 +62,126 @@ class XMLParser:
             Dict com os dados extraídos da nota fiscal
         """
         try:
-            # Remove namespaces para facilitar o parsing
-            xml_content = XMLParser._remove_namespaces(xml_content)
-            root = ET.fromstring(xml_content)
+            root = XMLParser.parse(xml_content)
             
-            # Extrai dados da nota fiscal
-            nf_data = XMLParser._extract_nf_data(root)
-            
-            # Extrai dados do destinatário/remetente
-            dest_data = XMLParser._extract_destinatario_data(root)
-            
-            # Extrai itens da nota fiscal
-            itens = XMLParser._extract_itens_data(root)
-            
-            # Determina o tipo de operação baseado no CFOP
-            cfop = XMLParser._extract_cfop(root)
-            tipo_operacao = XMLParser.CFOP_MAPPING.get(cfop, 'outros')
-            
-            return {
-                'numero': nf_data.get('numero'),
-                'serie': nf_data.get('serie'),
-                'chave_acesso': nf_data.get('chave_acesso'),
-                'data_emissao': nf_data.get('data_emissao'),
-                'cfop': cfop,
-                'tipo_operacao': tipo_operacao,
-                'destinatario_cnpj': dest_data.get('cnpj'),
-                'destinatario_nome': dest_data.get('nome'),
-                'itens': itens,
-                'xml_content': xml_content
-            }
+            nf_data = XMLParser.parse_root(root)
+            nf_data['xml_content'] = xml_content
+            return nf_data
             
         except Exception as e:
             raise ValueError(f"Erro ao processar XML: {str(e)}")
     
     @staticmethod
-    def _remove_namespaces(xml_content: str) -> str:
-        """Remove namespaces do XML para facilitar o parsing"""
-        # Remove declarações de namespace
-        xml_content = re.sub(r'\s*xmlns[^=]*="[^"]*"', '', xml_content)
-        # Remove prefixos de namespace das tags
-        xml_content = re.sub(r'</?[a-zA-Z0-9_]*:', '<', xml_content)
-        xml_content = re.sub(r'<([a-zA-Z0-9_]+)\s', r'<\1 ', xml_content)
-        return xml_content
+    def parse(xml_content: str) -> etree._Element:
+        """
+        Faz o parse do XML uma única vez, para validação e extração
+        
+        Raises:
+            etree.XMLSyntaxError: se o XML estiver malformado
+        """
+        return etree.fromstring(xml_content.encode('utf-8'), _PARSER)
+    
+    @staticmethod
+    def parse_stream(stream: IO[bytes]) -> Tuple[etree._Element, List[Dict]]:
+        """
+        Faz o parse incremental de um XML a partir de um stream de bytes
+        
+        Cada det é extraído assim que termina de ser lido e tem o conteúdo
+        descartado em seguida, de modo que a árvore em memória fica restrita
+        aos cabeçalhos; só o primeiro det é mantido inteiro, pois dele saem o
+        CFOP e a validação.
+        
+        Returns:
+            Tuple (elemento raiz, itens extraídos), para validate_root/parse_root
+        """
+        itens = []
+        context = etree.iterparse(
+            stream, events=('end',), tag='{*}det',
+            encoding='utf-8', resolve_entities=False, no_network=True
+        )
+        primeiro = True
+        for _, det in context:
+            item = XMLParser._extract_item_data(det)
+            if item is not None:
+                itens.append(item)
+            if primeiro:
+                primeiro = False
+            else:
+                det.clear(keep_tail=True)
+        
+        return context.root, itens
+    
+    @staticmethod
+    def parse_root(root: etree._Element, itens: Optional[List[Dict]] = None) -> Dict:
+        """
+        Extrai as informações relevantes de um XML já parseado
+        
+        Args:
+            root: Elemento raiz do XML
+            itens: Itens já extraídos durante o parse (parse_stream); se None,
+                são extraídos da árvore
+            
+        Returns:
+            Dict com os dados extraídos da nota fiscal
+        """
+        # As demais buscas partem de infNFe, por caminhos diretos do leiaute
+        inf_nfe = XMLParser._find_inf_nfe(root)
+        if inf_nfe is None:
+            raise ValueError("Tag 'infNFe' não encontrada no XML")
+        
+        # Determina o tipo de operação baseado no CFOP (antes dos itens, para
+        # que o chamador saiba de saída se a nota movimenta saldos)
+        cfop = XMLParser._extract_cfop(inf_nfe)
+        tipo_operacao = XMLParser.CFOP_MAPPING.get(cfop, 'outros')
+        
+        # Extrai dados da nota fiscal
+        nf_data = XMLParser._extract_nf_data(inf_nfe)
+        
+        # Extrai dados do destinatário/remetente
+        dest_data = XMLParser._extract_destinatario_data(inf_nfe)
+        
+        # Extrai itens da nota fiscal (gravados para qualquer CFOP)
+        if itens is None:
+            itens = XMLParser._extract_itens_data(inf_nfe)
+        
+        return {
+            'numero': nf_data.get('numero'),
+            'serie': nf_data.get('serie'),
+            'chave_acesso': nf_data.get('chave_acesso'),
+            'data_emissao': nf_data.get('data_emissao'),
+            'cfop': cfop,
+            'tipo_operacao': tipo_operacao,
+            'destinatario_cnpj': dest_data.get('cnpj'),
+            'destinatario_nome': dest_data.get('nome'),
+            'itens': itens
+        }
     
     @staticmethod
-    def _extract_nf_data(root: ET.Element) -> Dict:
+    def _find_inf_nfe(root: etree._Element) -> Optional[etree._Element]:
+        """
+        Localiza infNFe em nfeProc/NFe/infNFe ou NFe/infNFe
+        
+        Só percorre a árvore inteira para envelopes fora do leiaute.
+        """
+        inf_nfe = root.find('{*}NFe/{*}infNFe')
+        if inf_nfe is None:
+            inf_nfe = root.find('{*}infNFe')
+        if inf_nfe is None:
+            inf_nfe = root.find('.//{*}infNFe')
+        return inf_nfe
+    
+    @staticmethod
+    def _extract_nf_data(inf_nfe: etree._Element) -> Dict:
         """Extrai dados básicos da nota fiscal"""
-        ide = root.find('.//ide')
+        ide = inf_nfe.find('{*}ide')
         if ide is None:
             raise ValueError("Tag 'ide' não encontrada no XML")
         
         # Extrai chave de acesso
-        inf_nfe = root.find('.//infNFe')
-        chave_acesso = inf_nfe.get('Id', '').replace('NFe', '') if inf_nfe is not None else ''
+        chave_acesso = inf_nfe.get('Id', '').replace('NFe', '')
         
         # Extrai data de emissão
-        data_emissao_str = ide.findtext('dhEmi') or ide.findtext('dEmi')
+        data_emissao_str = ide.findtext('{*}dhEmi') or ide.findtext('{*}dEmi')
         data_emissao = None
         if data_emissao_str:
             try:
@@ -93,33 +189,37 @@ class XMLParser:
                 if 'T' in data_emissao_str:
                     data_emissao = datetime.fromisoformat(data_emissao_str.replace('Z', '+00:00'))
                 else:
-                    data_emissao = datetime.strptime(data_emissao_str, '%Y-%m-%d')
+                    data = _parse_data(data_emissao_str)
+                    data_emissao = datetime(data.year, data.month, data.day) if data else None
             except ValueError:
                 pass
         
         return {
-            'numero': ide.findtext('nNF'),
-            'serie': ide.findtext('serie'),
+            'numero': ide.findtext('{*}nNF'),
+            'serie': ide.findtext('{*}serie'),
             'chave_acesso': chave_acesso,
             'data_emissao': data_emissao
         }
     
     @staticmethod
-    def _extract_destinatario_data(root: ET.Element) -> Dict:
+    def _extract_destinatario_data(inf_nfe: etree._Element) -> Dict:
         """Extrai dados do destinatário"""
-        dest = root.find('.//dest')
+        dest = inf_nfe.find('{*}dest')
         if dest is None:
             # Se não há destinatário, pode ser uma nota de entrada, então pega o emitente
-            dest = root.find('.//emit')
+            dest = inf_nfe.find('{*}emit')
         
         if dest is None:
             return {'cnpj': '', 'nome': ''}
         
-        cnpj = dest.findtext('CNPJ') or dest.findtext('CPF') or ''
-        nome = dest.findtext('xNome') or dest.findtext('xFant') or ''
+        cnpj = dest.findtext('{*}CNPJ') or dest.findtext('{*}CPF') or ''
+        nome = dest.findtext('{*}xNome') or dest.findtext('{*}xFant') or ''
         
-        # Remove caracteres especiais do CNPJ/CPF
-        cnpj = re.sub(r'[^\d]', '', cnpj)
+        # Remove caracteres especiais do CNPJ/CPF (translate em C; a regex só
+        # é usada se sobrar algum caractere fora do ASCII)
+        cnpj = cnpj.translate(_NAO_DIGITOS_ASCII)
+        if not cnpj.isascii():
+            cnpj = re.sub(r'[^\d]', '', cnpj)
         
         return {
             'cnpj': cnpj,
@@ -127,56 +227,61 @@ class XMLParser:
         }
     
     @staticmethod
-    def _extract_cfop(root: ET.Element) -> str:
+    def _extract_cfop(inf_nfe: etree._Element) -> str:
         """Extrai o CFOP da nota fiscal (pega o primeiro item)"""
-        det = root.find('.//det')
+        det = inf_nfe.find('{*}det')
         if det is not None:
-            imposto = det.find('.//imposto')
+            imposto = det.find('{*}imposto')
             if imposto is not None:
-                # Procura CFOP em diferentes locais possíveis
-                cfop = (imposto.findtext('.//CFOP') or 
-                       det.findtext('.//CFOP') or 
-                       det.findtext('.//prod/CFOP'))
+                # Procura CFOP em diferentes locais possíveis (no leiaute, det/prod/CFOP)
+                cfop = (imposto.findtext('.//{*}CFOP') or 
+                       det.findtext('{*}prod/{*}CFOP') or 
+                       det.findtext('.//{*}CFOP'))
                 return cfop or ''
         return ''
     
     @staticmethod
-    def _extract_itens_data(root: ET.Element) -> List[Dict]:
+    def _extract_itens_data(inf_nfe: etree._Element) -> List[Dict]:
         """Extrai dados dos itens da nota fiscal"""
         itens = []
         
-        for det in root.findall('.//det'):
-            prod = det.find('prod')
-            if prod is None:
-                continue
-            
-            # Dados básicos do produto
-            codigo = prod.findtext('cProd') or ''
-            descricao = prod.findtext('xProd') or ''
-            quantidade = float(prod.findtext('qCom') or 0)
-            valor_unitario = float(prod.findtext('vUnCom') or 0)
-            valor_total = float(prod.findtext('vProd') or 0)
-            
-            # Extrai dados do lote
-            lote_data = XMLParser._extract_lote_data(det)
-            
-            item = {
-                'codigo_produto': codigo,
-                'descricao_produto': descricao,
-                'quantidade': quantidade,
-                'valor_unitario': valor_unitario,
-                'valor_total': valor_total,
-                'numero_lote': lote_data.get('numero_lote'),
-                'data_fabricacao': lote_data.get('data_fabricacao'),
-                'data_validade': lote_data.get('data_validade')
-            }
-            
-            itens.append(item)
+        for det in inf_nfe.iterfind('{*}det'):
+            item = XMLParser._extract_item_data(det)
+            if item is not None:
+                itens.append(item)
         
         return itens
     
     @staticmethod
-    def _extract_lote_data(det_element: ET.Element) -> Dict:
+    def _extract_item_data(det: etree._Element) -> Optional[Dict]:
+        """Extrai os dados de um item (det); None se o item não tem prod"""
+        prod = det.find('{*}prod')
+        if prod is None:
+            return None
+        
+        # Dados básicos do produto
+        codigo = prod.findtext('{*}cProd') or ''
+        descricao = prod.findtext('{*}xProd') or ''
+        quantidade = float(prod.findtext('{*}qCom') or 0)
+        valor_unitario = float(prod.findtext('{*}vUnCom') or 0)
+        valor_total = float(prod.findtext('{*}vProd') or 0)
+        
+        # Extrai dados do lote
+        lote_data = XMLParser._extract_lote_data(det)
+        
+        return {
+            'codigo_produto': codigo,
+            'descricao_produto': descricao,
+            'quantidade': quantidade,
+            'valor_unitario': valor_unitario,
+            'valor_total': valor_total,
+            'numero_lote': lote_data.get('numero_lote'),
+            'data_fabricacao': lote_data.get('data_fabricacao'),
+            'data_validade': lote_data.get('data_validade')
+        }
+    
+    @staticmethod
+    def _extract_lote_data(det_element: etree._Element) -> Dict:
         """Extrai dados do lote do item"""
         lote_data = {
             'numero_lote': None,
@@ -184,64 +289,43 @@ class XMLParser:
             'data_validade': None
         }
         
-        # Procura por dados de rastreabilidade
-        rastro = det_element.find('.//rastro')
+        # Procura por dados de rastreabilidade (det/prod/rastro)
+        rastro = det_element.find('{*}prod/{*}rastro')
         if rastro is not None:
-            lote_data['numero_lote'] = rastro.findtext('nLote')
+            lote_data['numero_lote'] = rastro.findtext('{*}nLote')
             
             # Datas de fabricação e validade
-            data_fab = rastro.findtext('dFab')
-            data_val = rastro.findtext('dVal')
+            data_fab = rastro.findtext('{*}dFab')
+            data_val = rastro.findtext('{*}dVal')
             
             if data_fab:
-                try:
-                    lote_data['data_fabricacao'] = datetime.strptime(data_fab, '%Y-%m-%d').date()
-                except ValueError:
-                    pass
+                lote_data['data_fabricacao'] = _parse_data(data_fab)
             
             if data_val:
-                try:
-                    lote_data['data_validade'] = datetime.strptime(data_val, '%Y-%m-%d').date()
-                except ValueError:
-                    pass
+                lote_data['data_validade'] = _parse_data(data_val)
         
         # Se não encontrou na tag rastro, procura em outras possíveis localizações
         if not lote_data['numero_lote']:
-            # Procura na tag med (medicamentos)
-            med = det_element.find('.//med')
+            # Procura na tag med (medicamentos, det/prod/med)
+            med = det_element.find('{*}prod/{*}med')
             if med is not None:
-                lote_data['numero_lote'] = med.findtext('nLote')
+                lote_data['numero_lote'] = med.findtext('{*}nLote')
                 
-                data_fab = med.findtext('dFab')
-                data_val = med.findtext('dVal')
+                data_fab = med.findtext('{*}dFab')
+                data_val = med.findtext('{*}dVal')
                 
                 if data_fab:
-                    try:
-                        lote_data['data_fabricacao'] = datetime.strptime(data_fab, '%Y-%m-%d').date()
-                    except ValueError:
-                        pass
+                    lote_data['data_fabricacao'] = _parse_data(data_fab)
                 
                 if data_val:
-                    try:
-                        lote_data['data_validade'] = datetime.strptime(data_val, '%Y-%m-%d').date()
-                    except ValueError:
-                        pass
+                    lote_data['data_validade'] = _parse_data(data_val)
             
             # Procura em infAdProd (informações adicionais) - FALLBACK PRINCIPAL
             if not lote_data['numero_lote']:
-                inf_ad_prod = det_element.findtext('.//infAdProd') or ''
-                # Procura padrões mais abrangentes como "LOTE: 123456", "Lote: 123456", "L: 123456"
-                lote_patterns = [
-                    r'lote[:\s]+([^\s,;\.]+)',  # LOTE: 123456
-                    r'l[:\s]+([^\s,;\.]+)',     # L: 123456
-                    r'lot[:\s]+([^\s,;\.]+)',   # LOT: 123456
-                    r'batch[:\s]+([^\s,;\.]+)', # BATCH: 123456
-                    r'nr[:\s]*lote[:\s]+([^\s,;\.]+)', # NR LOTE: 123456
-                    r'numero[:\s]*lote[:\s]+([^\s,;\.]+)' # NUMERO LOTE: 123456
-                ]
-                
-                for pattern in lote_patterns:
-                    lote_match = re.search(pattern, inf_ad_prod, re.IGNORECASE)
+                inf_ad_prod = det_element.findtext('{*}infAdProd') or ''
+                # Padrões em ordem de prioridade: o primeiro que casar define o lote
+                for pattern in XMLParser._LOTE_PATTERNS:
+                    lote_match = pattern.search(inf_ad_prod)
                     if lote_match:
                         lote_data['numero_lote'] = lote_match.group(1).strip()
                         break
@@ -257,32 +341,41 @@ class XMLParser:
             Tuple[bool, str]: (is_valid, error_message)
         """
         try:
-            xml_content = XMLParser._remove_namespaces(xml_content)
-            root = ET.fromstring(xml_content)
-            
-            # Verifica se é uma NFe
-            if root.find('.//infNFe') is None:
-                return False, "XML não é uma Nota Fiscal Eletrônica válida"
+            root = XMLParser.parse(xml_content)
             
-            # Verifica se tem dados básicos
-            ide = root.find('.//ide')
-            if ide is None:
-                return False, "Tag 'ide' não encontrada no XML"
+            return XMLParser.validate_root(root)
             
-            if not ide.findtext('nNF'):
-                return False, "Número da nota fiscal não encontrado"
-            
-            if not ide.findtext('serie'):
-                return False, "Série da nota fiscal não encontrada"
-            
-            # Verifica se tem pelo menos um item
-            if not root.findall('.//det'):
-                return False, "Nenhum item encontrado na nota fiscal"
-            
-            return True, ""
-            
-        except ET.ParseError as e:
+        except etree.XMLSyntaxError as e:
             return False, f"Erro ao fazer parse do XML: {str(e)}"
         except Exception as e:
             return False, f"Erro na validação: {str(e)}"
-
+    
+    @staticmethod
+    def validate_root(root: etree._Element) -> Tuple[bool, str]:
+        """
+        Valida a estrutura de uma NFe já parseada
+        
+        Returns:
+            Tuple[bool, str]: (is_valid, error_message)
+        """
+        # Verifica se é uma NFe
+        inf_nfe = XMLParser._find_inf_nfe(root)
+        if inf_nfe is None:
+            return False, "XML não é uma Nota Fiscal Eletrônica válida"
+        
+        # Verifica se tem dados básicos
+        ide = inf_nfe.find('{*}ide')
+        if ide is None:
+            return False, "Tag 'ide' não encontrada no XML"
+        
+        if not ide.findtext('{*}nNF'):
+            return False, "Número da nota fiscal não encontrado"
+        
+        if not ide.findtext('{*}serie'):
+            return False, "Série da nota fiscal não encontrada"
+        
+        # Verifica se tem pelo menos um item
+        if inf_nfe.find('{*}det') is None:
+            return False, "Nenhum item encontrado na nota fiscal"
+        
+        return True, ""